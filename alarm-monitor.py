@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Decoder for Texecom Connect API/Protocol
 #
@@ -21,13 +21,15 @@ from __future__ import print_function
 import os
 import sys
 import json
+import time
 
 from texecomConnect import TexecomConnect
+from texecomSinks import MqttSink, sinks_from_environment
 
 import paho.mqtt.client as paho
 
 broker_url = os.getenv('BROKER_URL','192.168.1.1')
-broker_port = os.getenv('BROKER_PORT',1883)
+broker_port = int(os.getenv('BROKER_PORT',1883))
 broker_user = os.getenv('BROKER_USER',None)
 broker_pass = os.getenv('BROKER_PASS',None)
 
@@ -35,7 +37,11 @@ def on_message(client, userdata, message):
     time.sleep(1)
     print("received message =",str(message.payload.decode("utf-8")))
 
-client = paho.Client()
+if hasattr(paho, "CallbackAPIVersion"):
+    # paho-mqtt 2.x
+    client = paho.Client(paho.CallbackAPIVersion.VERSION2)
+else:
+    client = paho.Client()
 
 client.username_pw_set(broker_user, broker_pass)
 client.on_message=on_message
@@ -102,30 +108,52 @@ class TexecomConnectMqtt(TexecomConnect):
         return area
 
 
+AREA_STATES = ["disarmed", "pending", "pending", "armed_away", "armed_night", "triggered"]
+
+
+def mqtt_messages(event):
+    """The MQTT state updates for a panel event, published by MqttSink"""
+    if event.get("zone_name") is not None:
+        topic = "homeassistant/binary_sensor/"+str.lower((event["zone_name"]).replace(" ", "_"))+"/state"
+        tc.log("MQTT Update %s: %s" % (topic, event["zone_state"]))
+        return [(topic, event["zone_state"])]
+    if event.get("area_name") is not None:
+        topic = "homeassistant/alarm_control_panel/" + str.lower((event["area_name"]).replace(" ", "_"))+"/state"
+        area_state = AREA_STATES[event["area_state"]]
+        tc.log("MQTT Update %s: %s" % (topic, area_state))
+        return [(topic, area_state)]
+    if event.get("output") is not None:
+        # only the outputs that changed
+        messages = []
+        for bit in range(8):
+            if event["output_changed"] & (1 << bit):
+                topic = "texecom/output/%d/%d/state" % (event["output"], bit + 1)
+                output_state = "1" if event["output_state"] & (1 << bit) else "0"
+                tc.log("MQTT Update %s: %s" % (topic, output_state))
+                messages.append((topic, output_state))
+        return messages
+    return []
+
+
 def message_handler(payload):
     tc.log(tc.decode_message_to_text(payload))
-    msg_type, payload = payload[0], payload[1:]
+    msg_type = payload[0]
     if msg_type == tc.MSG_ZONEEVENT:
-        zone_number = ord(payload[0])
-        zone_bitmap = ord(payload[1])
+        zone_event = tc.parse_zone_event(payload)
+        if zone_event is None:
+            return
+        zone_number, zone_bitmap = zone_event
         zone = tc.get_zone(zone_number)
         zone.state = zone_bitmap & 0x3
-        topic = "homeassistant/binary_sensor/"+str.lower((zone.text).replace(" ", "_"))+"/state"
         if zone.state == 1:
             zone.active = True
         else:
             zone.active = False
-        tc.log("MQTT Update %s: %s" % (topic, zone.state))
-        client.publish(topic,zone.state)
     elif msg_type == tc.MSG_AREAEVENT:
-        area_number = ord(payload[0])
-        area_state = ord(payload[1])
-        area_state_str = ["disarmed", "pending", "pending", "armed_away", "armed_night", "triggered"][area_state]
+        area_number = payload[1]
+        area_state = payload[2]
         area = tc.get_area(area_number)
-        area.state = area_state_str
-        topic = "homeassistant/alarm_control_panel/" + str.lower((area.name).replace(" ", "_"))+"/state"
-        tc.log("MQTT Update %s: %s" % (topic, area.state))
-        client.publish(topic, area.state)
+        area.state = AREA_STATES[area_state]
 
 
 # disable buffering to stdout when it's redirected to a file/pipe
@@ -148,7 +176,7 @@ class Unbuffered(object):
 
 if __name__ == '__main__':
     texhost = os.getenv('TEXHOST','192.168.1.9')
-    texport = os.getenv('TEXPORT',10001)
+    texport = int(os.getenv('TEXPORT',10001))
     # This is the default UDL password for a factory panel. For any real
     # installation, use wintex to set the UDL password in the panel to a
     # random 16 character alphanumeric string.
@@ -156,4 +184,18 @@ if __name__ == '__main__':
 
     sys.stdout = Unbuffered(sys.stdout)
     tc = TexecomConnectMqtt(texhost, texport, udlpassword, message_handler)
+    if os.getenv('CAPTURE_FILE'):
+        tc.start_capture(os.getenv('CAPTURE_FILE'))
+    if os.getenv('CHECKPOINT_FILE'):
+        tc.enable_checkpoints(os.getenv('CHECKPOINT_FILE'))
+    if os.getenv('STATE_FILE'):
+        tc.start_state_export(os.getenv('STATE_FILE'))
+    # zone and area states are published from the MQTT sink's own thread
+    tc.add_sink(MqttSink(client, mqtt_messages))
+    for sink in sinks_from_environment():
+        tc.add_sink(sink)
+    if os.getenv('HTTP_LISTEN'):
+        tc.start_http_server(os.getenv('HTTP_LISTEN'))
+    if os.getenv('PROFILE_FILE'):
+        tc.enable_profile_signals(os.getenv('PROFILE_FILE'))
     tc.event_loop()
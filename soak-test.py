@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+#
+# Soak/load test: run alarm-monitor.py (or texecomConnect.py) against a
+# scripted panel and MQTT broker stand-in and measure how it copes.
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# usage: ./soak-test.py [--duration 3600] [--rate 10] [--burst-every 120 --burst-size 100]
+#                       [--disconnect-every 600] [--target alarm-monitor|texecomConnect]
+#                       [--report report.json] [--max-lost N] [--max-p99 MS]
+#
+# The client is run as a subprocess pointed (via TEXHOST/TEXPORT and
+# BROKER_URL/BROKER_PORT) at a panel stand-in and an MQTT broker stand-in
+# on localhost. Once the client has loaded the zones, the panel sends zone
+# events at a steady rate, with periodic bursts, and drops the connection
+# periodically. Each zone event is matched against the MQTT state publish
+# it causes (or, for texecomConnect.py, the line written to a SINK_JOURNAL
+# file) to get its latency; events that never arrive are counted as lost.
+#
+# The report (JSON, on stdout or to --report) has latency percentiles,
+# the client's RSS over the run, reconnect times and event counts. Exits
+# with status 1 if the client died or a --max-lost/--max-p99 limit was
+# exceeded.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import crcmod
+
+crc8 = crcmod.mkCrcFun(poly=0x185, rev=False, initCrc=0xff)
+
+ZONE_TOPIC = re.compile(r"homeassistant/binary_sensor/zone_(\d+)/state$")
+
+
+def recv_exactly(s, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = s.recv(length - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+class EventTracker(object):
+    """Matches zone events sent by the panel stand-in with what the client
+    published. Events for a zone alternate between active and secure, so
+    arrive in order; anything overtaken by a later event was lost"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.unexpected = 0
+
+    def event_sent(self, zone, state, when):
+        with self.lock:
+            self.pending[zone].append((state, when))
+            self.sent += 1
+
+    def send_failed(self, zone):
+        with self.lock:
+            self.pending[zone].pop()
+            self.sent -= 1
+
+    def event_received(self, zone, state, when):
+        with self.lock:
+            pending = self.pending[zone]
+            while pending:
+                sent_state, sent_at = pending.popleft()
+                if sent_state == state:
+                    self.received += 1
+                    self.latencies.append(when - sent_at)
+                    return
+                self.lost += 1
+            self.unexpected += 1
+
+    def outstanding(self):
+        with self.lock:
+            return sum(len(pending) for pending in self.pending.values())
+
+    def finish(self):
+        with self.lock:
+            self.lost += sum(len(pending) for pending in self.pending.values())
+            self.pending.clear()
+
+
+class PanelStandIn(object):
+    """A scripted panel: answers the commands the client sends while
+    connecting and loading site data, and sends zone events on demand"""
+
+    IDENTIFICATION = b"Elite 24 SOAK V4.00.01"
+
+    def __init__(self, zones, tracker):
+        self.zones = zones
+        self.tracker = tracker
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.lock = threading.Lock()
+        self.conn = None
+        self.message_seq = 0
+        self.zones_loaded = threading.Event()
+        self.zone_states = [0] * (zones + 1)
+        self.next_zone = 1
+        self.dropped_at = None
+        self.reconnect_times = []
+        self.sessions = 0
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def frame(frame_type, seq, body):
+        data = bytearray(b"t" + frame_type) + bytearray([len(body) + 5, seq]) + body
+        data.append(crc8(bytes(data)))
+        return bytes(data)
+
+    def run(self):
+        while True:
+            conn, _ = self.listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self.serve(conn)
+            except (EOFError, socket.error):
+                pass
+            with self.lock:
+                if self.conn is conn:
+                    self.conn = None
+            conn.close()
+
+    def serve(self, conn):
+        while True:
+            header = recv_exactly(conn, 4)
+            body = recv_exactly(conn, header[2] - 4)
+            command, args = body[0], body[1:-1]
+            response = self.response(command, args)
+            if response is None:
+                continue
+            with self.lock:
+                conn.sendall(self.frame(b"R", header[3], bytearray([command]) + response))
+                if command == 37:
+                    # set event messages is the last command of a new session
+                    self.conn = conn
+                    self.sessions += 1
+                    if self.dropped_at is not None:
+                        self.reconnect_times.append(time.time() - self.dropped_at)
+                        self.dropped_at = None
+            if command == 3 and args[0] == self.zones:
+                self.zones_loaded.set()
+
+    def response(self, command, args):
+        if command in (1, 37):
+            return bytearray(b"\x06")
+        if command == 22:
+            return bytearray(self.IDENTIFICATION.ljust(32))
+        if command == 23:
+            now = time.localtime()
+            return bytearray([now.tm_mday, now.tm_mon, now.tm_year % 100, now.tm_hour, now.tm_min, now.tm_sec])
+        if command == 25:
+            return bytearray([100, 105, 103, 20, 2])
+        if command == 15:
+            return bytearray([5, 1])
+        if command == 13:
+            return bytearray(b"  Soak test".ljust(32))
+        if command == 3:
+            # zones are 24hr audible, a zone type that isn't debounced, so every event should get through
+            name = "Zone {:d}".format(args[0]).encode("ascii")
+            return bytearray([5 if args[0] <= self.zones else 0, 3]) + bytearray(name.ljust(32, b"\x00"))
+        if command == 35:
+            name = "Area {:d}".format(args[0]).encode("ascii")
+            return bytearray([args[0]]) + bytearray(name.ljust(16, b"\x00")) + bytearray(8)
+        if command == 27:
+            return bytearray(8) + bytearray([0xff] * 3) + bytearray(12)
+        return None
+
+    def send_zone_event(self):
+        """Send an event for the next zone, flipping its state. Returns
+        False if there's no session with the client"""
+        with self.lock:
+            if self.conn is None:
+                return False
+            zone = self.next_zone
+            self.next_zone = self.next_zone % self.zones + 1
+            state = self.zone_states[zone] ^ 1
+            self.tracker.event_sent(zone, state, time.time())
+            try:
+                self.conn.sendall(self.frame(b"M", self.message_seq, bytearray([1, zone, state])))
+            except socket.error:
+                self.tracker.send_failed(zone)
+                return False
+            self.zone_states[zone] = state
+            self.message_seq = (self.message_seq + 1) & 0xff
+            return True
+
+    def drop_connection(self):
+        with self.lock:
+            if self.conn is None:
+                return False
+            self.conn.shutdown(socket.SHUT_RDWR)
+            self.conn = None
+            self.dropped_at = time.time()
+            return True
+
+
+class MqttBrokerStandIn(object):
+    """Just enough of an MQTT 3.1.1 broker to accept a client's publishes"""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.publishes = 0
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            conn, _ = self.listener.accept()
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, conn):
+        try:
+            while True:
+                first = recv_exactly(conn, 1)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = recv_exactly(conn, 1)[0]
+                    length |= (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                packet = recv_exactly(conn, length)
+                packet_type = first >> 4
+                if packet_type == 1:
+                    conn.sendall(b"\x20\x02\x00\x00")
+                elif packet_type == 3:
+                    self.publish(conn, (first >> 1) & 3, packet)
+                elif packet_type == 8:
+                    conn.sendall(b"\x90\x03" + bytes(packet[0:2]) + b"\x00")
+                elif packet_type == 12:
+                    conn.sendall(b"\xd0\x00")
+                elif packet_type == 14:
+                    return
+        except (EOFError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def publish(self, conn, qos, packet):
+        when = time.time()
+        topic_length = (packet[0] << 8) | packet[1]
+        topic = packet[2:2 + topic_length].decode("utf-8")
+        offset = 2 + topic_length
+        if qos:
+            conn.sendall(b"\x40\x02" + bytes(packet[offset:offset + 2]))
+            offset += 2
+        self.publishes += 1
+        match = ZONE_TOPIC.match(topic)
+        if match:
+            self.tracker.event_received(int(match.group(1)), int(bytes(packet[offset:])), when)
+
+
+class JournalTail(object):
+    """Follows a SINK_JOURNAL file written by texecomConnect.py"""
+
+    def __init__(self, filename, tracker):
+        self.filename = filename
+        self.tracker = tracker
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while not os.path.exists(self.filename):
+            time.sleep(0.01)
+        with open(self.filename) as f:
+            partial = ""
+            while True:
+                line = f.readline()
+                if not line:
+                    time.sleep(0.002)
+                    continue
+                partial += line
+                if not partial.endswith("\n"):
+                    continue
+                event = json.loads(partial)
+                partial = ""
+                if "zone" in event:
+                    self.tracker.event_received(event["zone"], event["zone_state"], time.time())
+
+
+def rss_kb(pid):
+    try:
+        with open("/proc/{:d}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Soak/load test a Texecom client against local stand-ins")
+    parser.add_argument("--target", choices=["alarm-monitor", "texecomConnect"], default="alarm-monitor")
+    parser.add_argument("--duration", type=float, default=3600, help="seconds to send events for")
+    parser.add_argument("--zones", type=int, default=24)
+    parser.add_argument("--rate", type=float, default=10, help="zone events per second")
+    parser.add_argument("--burst-every", type=float, default=120, help="seconds between bursts, 0 for none")
+    parser.add_argument("--burst-size", type=int, default=100)
+    parser.add_argument("--disconnect-every", type=float, default=600, help="seconds between disconnects, 0 for none")
+    parser.add_argument("--sample-every", type=float, default=10, help="seconds between RSS samples")
+    parser.add_argument("--grace", type=float, default=10, help="seconds to wait for outstanding events at the end")
+    parser.add_argument("--client-log", default=os.devnull, help="file for the client's output")
+    parser.add_argument("--report", help="write the report here instead of stdout")
+    parser.add_argument("--max-lost", type=int)
+    parser.add_argument("--max-p99", type=float, help="milliseconds")
+    return parser.parse_args()
+
+
+def start_client(args, panel, broker, journal):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env.update({
+        "TEXHOST": "127.0.0.1",
+        "TEXPORT": str(panel.port),
+        "UDLPASSWORD": "1234",
+        "BROKER_URL": "127.0.0.1",
+        "BROKER_PORT": str(broker.port),
+        "NOTIFY_SCRIPT": "",
+    })
+    if journal is not None:
+        env["SINK_JOURNAL"] = journal
+    log = open(args.client_log, "a")
+    return subprocess.Popen([sys.executable, args.target + ".py"], cwd=here, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def main():
+    args = parse_args()
+    tracker = EventTracker()
+    panel = PanelStandIn(args.zones, tracker)
+    broker = MqttBrokerStandIn(tracker)
+    journal = None
+    if args.target == "texecomConnect":
+        journal = os.path.join(tempfile.mkdtemp(), "journal.jsonl")
+        JournalTail(journal, tracker)
+
+    client = start_client(args, panel, broker, journal)
+    failure = None
+    try:
+        started = time.time()
+        while not panel.zones_loaded.wait(1):
+            if client.poll() is not None or time.time() - started > 120:
+                raise RuntimeError("client didn't load the zones")
+        # let the client process the last zone details
+        time.sleep(1)
+        load_time = time.time() - started
+
+        rss = [rss_kb(client.pid)]
+        bursts = disconnects = skipped = 0
+        start = time.time()
+        end = start + args.duration
+        next_event = next_sample = start
+        next_burst = start + args.burst_every if args.burst_every else end
+        next_disconnect = start + args.disconnect_every if args.disconnect_every else end
+        while time.time() < end:
+            now = time.time()
+            if client.poll() is not None:
+                failure = "client exited with status {:d}".format(client.returncode)
+                break
+            if now >= next_disconnect:
+                if panel.drop_connection():
+                    disconnects += 1
+                next_disconnect += args.disconnect_every
+            if now >= next_burst:
+                for _ in range(args.burst_size):
+                    if not panel.send_zone_event():
+                        skipped += 1
+                bursts += 1
+                next_burst += args.burst_every
+            while now >= next_event:
+                if not panel.send_zone_event():
+                    skipped += 1
+                next_event += 1 / args.rate
+            if now >= next_sample:
+                rss.append(rss_kb(client.pid))
+                next_sample += args.sample_every
+            time.sleep(max(0, min(next_event, next_sample) - time.time()))
+
+        grace_end = time.time() + args.grace
+        while tracker.outstanding() and time.time() < grace_end and client.poll() is None:
+            time.sleep(0.1)
+        rss.append(rss_kb(client.pid))
+        tracker.finish()
+    finally:
+        if client.poll() is None:
+            client.terminate()
+            client.wait()
+
+    rss = [sample for sample in rss if sample is not None]
+    latencies = sorted(tracker.latencies)
+    reconnects = panel.reconnect_times
+    report = {
+        "target": args.target,
+        "duration": round(time.time() - start, 1),
+        "load_time": round(load_time, 3),
+        "failure": failure,
+        "events": {
+            "sent": tracker.sent,
+            "received": tracker.received,
+            "lost": tracker.lost,
+            "unexpected": tracker.unexpected,
+            "not_sent_while_disconnected": skipped,
+        },
+        "latency_ms": {
+            "count": len(latencies),
+            "p50": milliseconds(percentile(latencies, 0.5)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "p999": milliseconds(percentile(latencies, 0.999)),
+            "max": milliseconds(latencies[-1] if latencies else None),
+        },
+        "rss_kb": {
+            "start": rss[0] if rss else None,
+            "end": rss[-1] if rss else None,
+            "max": max(rss) if rss else None,
+            "growth": rss[-1] - rss[0] if rss else None,
+        },
+        "reconnects": {
+            "disconnects": disconnects,
+            "sessions": panel.sessions,
+            "count": len(reconnects),
+            "mean_s": round(sum(reconnects) / len(reconnects), 3) if reconnects else None,
+            "max_s": round(max(reconnects), 3) if reconnects else None,
+        },
+        "bursts": bursts,
+        "mqtt_publishes": broker.publishes,
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    failed = failure is not None
+    if args.max_lost is not None and tracker.lost > args.max_lost:
+        failed = True
+    if args.max_p99 is not None and latencies and percentile(latencies, 0.99) * 1000 > args.max_p99:
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
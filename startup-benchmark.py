@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Measure how long it takes to start up: import texecomConnect and create a
+# TexecomConnect, each in a fresh interpreter.
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# usage: ./startup-benchmark.py [runs] [max milliseconds]
+#
+# Exits with status 1 if the median startup time is over the maximum, so it
+# can be used to check startup hasn't got slower.
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+STARTUP = """
+import sys, time
+start = time.time()
+import texecomConnect
+texecomConnect.TexecomConnect('127.0.0.1', 10001, '1234', None)
+sys.stdout.write(str((time.time() - start) * 1000))
+"""
+
+# modules that should only be imported when the feature needing them is used
+LAZY_MODULES = ["hexdump", "paho", "texecomProfile"]
+
+CHECK_LAZY = """
+import sys
+import texecomConnect
+texecomConnect.TexecomConnect('127.0.0.1', 10001, '1234', None)
+sys.stdout.write(' '.join(m for m in %r if m in sys.modules))
+""" % LAZY_MODULES
+
+
+def run(code):
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.check_output([sys.executable, "-c", code], cwd=here).decode("ascii")
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    max_ms = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    # the first run also compiles the module, so isn't counted
+    run(STARTUP)
+    times = sorted(float(run(STARTUP)) for _ in range(runs))
+    median = times[len(times) // 2]
+    print("startup: median {:.1f}ms min {:.1f}ms max {:.1f}ms over {:d} runs".format(
+        median, times[0], times[-1], runs))
+
+    failed = False
+    imported = run(CHECK_LAZY)
+    if imported:
+        print("imported at startup but should be lazy: " + imported)
+        failed = True
+    if max_ms is not None and median > max_ms:
+        print("median startup time is over the {:.1f}ms limit".format(max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
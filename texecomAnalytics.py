@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+#
+# Occupancy analytics over recorded Texecom panel events
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Loads the zone and log events from pcap captures (see texecomPcap.py) into
+# numpy arrays and works out, without looping over the events in python:
+#
+#   zone_heatmap.csv   zone activations by weekday and hour
+#   log_heatmap.csv    log events by type, weekday and hour (panel time)
+#   dwell.csv          how long each zone stays active
+#   coactivation.csv   how often pairs of zones are active at the same time
+#
+# usage: ./texecomAnalytics.py [--out DIR] [--bin SECONDS] capture.pcap [capture.pcap ...]
+#
+# Requires numpy.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+
+from texecomPcap import read_pcap
+
+MSG_ZONEEVENT = 1
+MSG_LOGEVENT = 5
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def local_utc_offset():
+    if time.daylight and time.localtime().tm_isdst:
+        return -time.altzone
+    return -time.timezone
+
+
+def decode_panel_timestamps(packed):
+    """Decode an array of 32 bit packed panel timestamps, laid out as in
+    TexecomConnect.decode_message_to_text, to datetime64[s]"""
+    packed = np.asarray(packed, dtype=np.uint32)
+    seconds = (packed & 63).astype(np.int64)
+    minutes = ((packed >> 6) & 63).astype(np.int64)
+    month = ((packed >> 12) & 15).astype(np.int64)
+    hours = ((packed >> 16) & 31).astype(np.int64)
+    day = ((packed >> 21) & 31).astype(np.int64)
+    year = 2000 + ((packed >> 26) & 63).astype(np.int64)
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    return (months.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")).astype("datetime64[s]") + \
+        (hours * 3600 + minutes * 60 + seconds).astype("timedelta64[s]")
+
+
+# layouts of the log event message payload (after the message type byte)
+LOG_RECORD_DTYPES = {
+    8: np.dtype([("event_type", "u1"), ("group", "u1"), ("parameter", "u1"), ("areas", "u1"),
+                 ("timestamp", "<u4")]),
+    # Premier 168 - 16 bits of area info, with the high byte at the end
+    9: np.dtype([("event_type", "u1"), ("group", "u1"), ("parameter", "u1"), ("areas", "u1"),
+                 ("timestamp", "<u4"), ("areas_high", "u1")]),
+    # Premier 640
+    10: np.dtype([("event_type", "u1"), ("group", "u1"), ("parameter", "<u2"), ("areas", "<u2"),
+                  ("timestamp", "<u4")]),
+}
+
+
+def decode_log_records(buffer, record_length):
+    """Decode a buffer holding any number of log event payloads of the same
+    length (8, 9 or 10 bytes) in one pass. Returns a dict of columns:
+    event_type, group_type, comm_delayed, communicated, parameter, areas and
+    timestamp (datetime64[s])"""
+    records = np.frombuffer(buffer, dtype=LOG_RECORD_DTYPES[record_length])
+    areas = records["areas"].astype(np.int64)
+    if record_length == 9:
+        areas |= records["areas_high"].astype(np.int64) << 8
+    group = records["group"]
+    return {
+        "event_type": records["event_type"].astype(np.int64),
+        "group_type": group & 0b00111111,
+        "comm_delayed": (group & 0b01000000) != 0,
+        "communicated": (group & 0b10000000) != 0,
+        "parameter": records["parameter"].astype(np.int64),
+        "areas": areas,
+        "timestamp": decode_panel_timestamps(records["timestamp"]),
+    }
+
+
+def weekday_hour(datetimes):
+    """Weekday (0 is Monday) and hour of day for an array of datetime64"""
+    days = datetimes.astype("datetime64[D]").astype(np.int64)
+    # 1970-01-01 was a Thursday
+    weekday = (days + 3) % 7
+    hour = (datetimes.astype("datetime64[h]").astype(np.int64)) % 24
+    return weekday, hour
+
+
+class Events(object):
+    """Zone and log events as columns of numpy arrays"""
+    def __init__(self, zone_time, zone_number, zone_bitmap, log_time, log):
+        # capture timestamps (seconds since the epoch) for zone events, as they don't carry a panel time
+        self.zone_time = zone_time
+        self.zone_number = zone_number
+        self.zone_bitmap = zone_bitmap
+        self.log_time = log_time
+        self.log_type = log["event_type"]
+        self.log_group = log["group_type"]
+        self.log_comm_delayed = log["comm_delayed"]
+        self.log_communicated = log["communicated"]
+        self.log_parameter = log["parameter"]
+        self.log_areas = log["areas"]
+        # panel time of each log event as datetime64[s]
+        self.log_timestamp = log["timestamp"]
+
+
+def load_captures(filenames):
+    zone_time, zone_number, zone_bitmap = [], [], []
+    # log event payloads and capture times, by payload length, to be decoded in bulk
+    log_time = dict((length, []) for length in LOG_RECORD_DTYPES)
+    log_payloads = dict((length, []) for length in LOG_RECORD_DTYPES)
+    for filename in filenames:
+        for timestamp, sent, data in read_pcap(filename):
+            frame = bytearray(data)
+            if sent or len(frame) < 6 or frame[1] != ord("M"):
+                continue
+            msg_type = frame[4]
+            if msg_type == MSG_ZONEEVENT:
+                if len(frame) == 8:
+                    zone_number.append(frame[5])
+                    zone_bitmap.append(frame[6])
+                elif len(frame) == 9:
+                    zone_number.append(frame[5] + (frame[6] << 8))
+                    zone_bitmap.append(frame[7])
+                else:
+                    continue
+                zone_time.append(timestamp)
+            elif msg_type == MSG_LOGEVENT:
+                length = len(frame) - 6
+                if length in log_payloads:
+                    log_time[length].append(timestamp)
+                    log_payloads[length].append(bytes(frame[5:-1]))
+
+    columns = [decode_log_records(b"".join(log_payloads[length]), length) for length in sorted(LOG_RECORD_DTYPES)]
+    times = np.concatenate([np.array(log_time[length], dtype=np.float64) for length in sorted(LOG_RECORD_DTYPES)])
+    order = np.argsort(times, kind="stable")
+    log = dict((name, np.concatenate([c[name] for c in columns])[order]) for name in columns[0])
+    return Events(np.array(zone_time, dtype=np.float64), np.array(zone_number, dtype=np.int64),
+                  np.array(zone_bitmap, dtype=np.uint8), times[order], log)
+
+
+def zone_active_intervals(events):
+    """Returns (zone, start, end) arrays for each period a zone was active,
+    from the time it went active to the time it next went secure"""
+    order = np.lexsort((events.zone_time, events.zone_number))
+    zone = events.zone_number[order]
+    when = events.zone_time[order]
+    active = (events.zone_bitmap[order] & 0x3) == 1
+    if len(zone) < 2:
+        empty = np.array([], dtype=np.int64)
+        return empty, np.array([], dtype=np.float64), np.array([], dtype=np.float64)
+    same_zone = zone[1:] == zone[:-1]
+    rising = np.flatnonzero(same_zone & active[1:] & ~active[:-1]) + 1
+    # the first event seen for a zone counts as going active if it's active
+    first = np.flatnonzero(np.concatenate(([True], ~same_zone)))
+    rising = np.union1d(rising, first[active[first]])
+    falling = np.flatnonzero(same_zone & ~active[1:] & active[:-1]) + 1
+    # pair each activation with the next deactivation of the same zone
+    ends = np.searchsorted(falling, rising)
+    has_end = ends < len(falling)
+    rising, ends = rising[has_end], falling[ends[has_end]]
+    paired = zone[ends] == zone[rising]
+    rising, ends = rising[paired], ends[paired]
+    return zone[rising], when[rising], when[ends]
+
+
+def zone_heatmap(events, utc_offset):
+    """Activations per zone, weekday and hour: array of shape (zones, 7, 24)"""
+    zones = int(events.zone_number.max()) + 1 if len(events.zone_number) else 1
+    heat = np.zeros((zones, 7, 24), dtype=np.int64)
+    activations = (events.zone_bitmap & 0x3) == 1
+    local = (events.zone_time[activations] + utc_offset).astype("datetime64[s]")
+    weekday, hour = weekday_hour(local)
+    np.add.at(heat, (events.zone_number[activations], weekday, hour), 1)
+    return heat
+
+
+def log_heatmap(events):
+    """Log events per event type, weekday and hour of panel time: array of shape (types, 7, 24)"""
+    types = int(events.log_type.max()) + 1 if len(events.log_type) else 1
+    heat = np.zeros((types, 7, 24), dtype=np.int64)
+    weekday, hour = weekday_hour(events.log_timestamp)
+    np.add.at(heat, (events.log_type, weekday, hour), 1)
+    return heat
+
+
+def dwell_times(zone, start, end):
+    """Per zone count, mean, median and max of the time spent active"""
+    durations = end - start
+    results = []
+    if len(zone) == 0:
+        return results
+    order = np.argsort(zone, kind="stable")
+    zone, durations = zone[order], durations[order]
+    numbers, first, counts = np.unique(zone, return_index=True, return_counts=True)
+    sums = np.add.reduceat(durations, first)
+    maxes = np.maximum.reduceat(durations, first)
+    for number, index, count, total, longest in zip(numbers, first, counts, sums, maxes):
+        results.append((int(number), int(count), total / count,
+                        float(np.median(durations[index:index + count])), float(longest)))
+    return results
+
+
+def coactivation(zone, start, end, bin_seconds):
+    """Returns (zones, both, correlation): the zones seen active, how many
+    time bins each pair of zones were both active in, and the correlation
+    of their activity"""
+    if len(zone) == 0:
+        return np.array([], dtype=np.int64), np.zeros((0, 0)), np.zeros((0, 0))
+    zones, row = np.unique(zone, return_inverse=True)
+    origin = start.min()
+    first_bin = ((start - origin) // bin_seconds).astype(np.int64)
+    last_bin = ((end - origin) // bin_seconds).astype(np.int64)
+    bins = int(last_bin.max()) + 2
+    # mark each active interval as +1 at its first bin and -1 after its last, then integrate
+    changes = np.zeros((len(zones), bins), dtype=np.int32)
+    np.add.at(changes, (row, first_bin), 1)
+    np.add.at(changes, (row, last_bin + 1), -1)
+    active = (np.cumsum(changes, axis=1) > 0).astype(np.float64)
+    both = active.dot(active.T)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = np.nan_to_num(np.corrcoef(active)) if len(zones) > 1 else np.ones((1, 1))
+    return zones, both, correlation
+
+
+def write_csv(filename, header, rows):
+    with open(filename, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def write_heatmap(filename, label, heat):
+    index, weekday, hour = np.nonzero(heat)
+    write_csv(filename, [label, "weekday", "hour", "count"],
+              zip(index.tolist(), [WEEKDAYS[day] for day in weekday], hour.tolist(),
+                  heat[index, weekday, hour].tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Occupancy analytics over pcap captures of panel traffic")
+    parser.add_argument("--out", default=".", help="directory to write the CSV files to")
+    parser.add_argument("--bin", type=float, default=60, help="time bin in seconds for co-activation")
+    parser.add_argument("--utc-offset", type=float, default=None,
+                        help="seconds to add to capture times to get local time (default: this machine's)")
+    parser.add_argument("captures", nargs="+")
+    args = parser.parse_args()
+    utc_offset = local_utc_offset() if args.utc_offset is None else args.utc_offset
+
+    events = load_captures(args.captures)
+    print("{:d} zone events, {:d} log events".format(len(events.zone_number), len(events.log_type)))
+
+    write_heatmap(os.path.join(args.out, "zone_heatmap.csv"), "zone", zone_heatmap(events, utc_offset))
+    write_heatmap(os.path.join(args.out, "log_heatmap.csv"), "log_event_type", log_heatmap(events))
+
+    zone, start, end = zone_active_intervals(events)
+    write_csv(os.path.join(args.out, "dwell.csv"), ["zone", "activations", "mean", "median", "max"],
+              dwell_times(zone, start, end))
+
+    zones, both, correlation = coactivation(zone, start, end, args.bin)
+    a, b = np.triu_indices(len(zones), 1)
+    write_csv(os.path.join(args.out, "coactivation.csv"), ["zone_a", "zone_b", "bins_both_active", "correlation"],
+              zip(zones[a].tolist(), zones[b].tolist(), both[a, b].astype(np.int64).tolist(),
+                  np.round(correlation[a, b], 4).tolist()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#
+# Checkpoints of a TexecomConnect's state, so it can carry on after a restart
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Checkpoints are JSON. They're written to a temporary file which is synced
+# and then renamed over the old checkpoint, so a crash part way through
+# leaves the previous checkpoint intact. User passcodes and tags are never
+# written.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from texecomConnect import Area, User
+
+CHECKPOINT_VERSION = 1
+
+AREA_FIELDS = ("name", "state", "exitDelay", "entry1Delay", "entry2Delay", "secondEntry")
+USER_FIELDS = ("name", "areas", "config")
+
+
+def copy_fields(source, fields):
+    return dict((field, getattr(source, field)) for field in fields if hasattr(source, field))
+
+
+def save_checkpoint(tc, filename):
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "saved": time.time(),
+        "panel": {
+            "type": tc.panelType,
+            "zones": tc.numberOfZones,
+            "firmware": tc.firmwareVersion,
+        },
+        "zones": [zone.checkpoint() for zone in tc.zone.values()],
+        "zone_bitmaps": sorted(tc.area_index.zone_bitmap.items()),
+        "area_states": sorted(tc.area_index.area_state.items()),
+        "areas": [dict(copy_fields(area, AREA_FIELDS), number=number)
+                  for number, area in tc.area.items() if area is not None],
+        "users": [dict(copy_fields(user, USER_FIELDS), number=number) for number, user in tc.user.items()],
+    }
+    temporary = filename + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(checkpoint, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary, filename)
+
+
+def load_checkpoint(tc, filename):
+    """Restore the state saved by save_checkpoint. Returns the time the
+    checkpoint was saved, or None if there isn't a usable one"""
+    try:
+        with open(filename) as f:
+            checkpoint = json.load(f)
+    except (IOError, ValueError) as e:
+        tc.log("Not restoring from checkpoint {} - {}".format(filename, e))
+        return None
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        tc.log("Not restoring from checkpoint {} - wrong version".format(filename))
+        return None
+    panel = checkpoint["panel"]
+    tc.panelType = panel["type"]
+    tc.numberOfZones = panel["zones"]
+    tc.firmwareVersion = panel["firmware"]
+    for saved in checkpoint["zones"]:
+        zone = tc.get_zone(saved["number"])
+        zone.restore(saved)
+        if hasattr(zone, "areaBitmap"):
+            tc.area_index.set_zone_areas(zone.number, zone.areaBitmap if zone.zoneType != tc.ZONETYPE_UNUSED else 0)
+    for zone_number, zone_bitmap in checkpoint["zone_bitmaps"]:
+        tc.area_index.update_zone(zone_number, zone_bitmap)
+        tc.debouncer.emitted[zone_number] = zone_bitmap
+    # not in checkpoints saved before area states were
+    for area_number, area_state in checkpoint.get("area_states", ()):
+        tc.area_index.update_area(area_number, area_state)
+    for saved in checkpoint["areas"]:
+        area = Area()
+        area.__dict__.update(saved)
+        del area.number
+        tc.area[saved["number"]] = area
+    for saved in checkpoint["users"]:
+        user = User()
+        user.__dict__.update(saved)
+        del user.number
+        tc.user[saved["number"]] = user
+    tc.decode_cache.clear()
+    return checkpoint["saved"]
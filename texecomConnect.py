@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Decoder for Texecom Connect API/Protocol
 #
@@ -22,13 +22,22 @@ from __future__ import print_function
 
 import socket
 import time
+import atexit
+import collections
 import datetime
+import fcntl
+import heapq
+import itertools
 import os
 import sys
 import re
+import select
+import struct
+import threading
 
 import crcmod
-import hexdump
+
+from texecomTrace import FrameTrace
 
 class User(object):
     def __init__(self):
@@ -44,6 +53,82 @@ class Area(object):
         self.name = "unknown"
         self.state = "unknown"
 
+class ZoneStats(object):
+    """Activity statistics for a zone. They are updated on each change of
+    state so that answering any of the queries doesn't need the history"""
+    def __init__(self, recent=32):
+        self.activations = 0
+        # activations in each of the last 24 hours, indexed by hour number % 24
+        self.hourly = [0] * 24
+        self.hourly_hour = [None] * 24
+        self.today = None
+        self.activations_today_count = 0
+        # how long the zone stayed active for
+        self.durations = 0
+        self.total_duration = 0.0
+        self.min_duration = None
+        self.max_duration = None
+        # (time, active) for the most recent changes of state
+        self.recent = collections.deque(maxlen=recent)
+
+    def activated(self, when):
+        self.activations += 1
+        hour = int(when // 3600)
+        bucket = hour % 24
+        if self.hourly_hour[bucket] != hour:
+            self.hourly_hour[bucket] = hour
+            self.hourly[bucket] = 0
+        self.hourly[bucket] += 1
+        day = datetime.date.fromtimestamp(when)
+        if day != self.today:
+            self.today = day
+            self.activations_today_count = 0
+        self.activations_today_count += 1
+        self.recent.append((when, True))
+
+    def deactivated(self, when, duration):
+        self.durations += 1
+        self.total_duration += duration
+        if self.min_duration is None or duration < self.min_duration:
+            self.min_duration = duration
+        if self.max_duration is None or duration > self.max_duration:
+            self.max_duration = duration
+        self.recent.append((when, False))
+
+    def activations_today(self):
+        if self.today != datetime.date.today():
+            return 0
+        return self.activations_today_count
+
+    def activations_last_24_hours(self):
+        hour = int(time.time() // 3600)
+        return sum(count for count, bucket_hour in zip(self.hourly, self.hourly_hour)
+                   if bucket_hour is not None and hour - bucket_hour < 24)
+
+    def activations_in_hour(self, when):
+        """Activations in the hour containing the timestamp 'when', if it was within the last 24 hours"""
+        hour = int(when // 3600)
+        bucket = hour % 24
+        if self.hourly_hour[bucket] != hour:
+            return 0
+        return self.hourly[bucket]
+
+    def mean_duration(self):
+        if self.durations == 0:
+            return None
+        return self.total_duration / self.durations
+
+    def summary(self):
+        return {
+            "activations": self.activations,
+            "activations_today": self.activations_today(),
+            "activations_last_24_hours": self.activations_last_24_hours(),
+            "min_duration": self.min_duration,
+            "max_duration": self.max_duration,
+            "mean_duration": self.mean_duration(),
+        }
+
+
 class Zone(object):
     """Information about a zone and it's current state
     """
@@ -59,7 +144,25 @@ class Zone(object):
         self.smoothed_active_func = None
         self.smoothed_active_since = None
         self.smoothed_last_active = None
-        pass
+        self.stats = ZoneStats()
+
+    # the attributes saved in checkpoints, see texecomCheckpoint.py
+    CHECKPOINT_FIELDS = ("number", "text", "zoneType", "areaBitmap", "state", "active_since", "last_active",
+                         "smoothed_active_since", "smoothed_last_active")
+
+    def checkpoint(self):
+        saved = dict((field, getattr(self, field)) for field in self.CHECKPOINT_FIELDS if hasattr(self, field))
+        saved["active"] = self.__active
+        saved["smoothed_active"] = self.__smoothed_active
+        return saved
+
+    def restore(self, saved):
+        """Restore a checkpoint, without calling active_func etc as nothing has changed"""
+        for field in self.CHECKPOINT_FIELDS:
+            if field in saved:
+                setattr(self, field, saved[field])
+        self.__active = saved["active"]
+        self.__smoothed_active = saved["smoothed_active"]
 
     def update(self):
         if self.smoothed_active and not self.active:
@@ -104,28 +207,468 @@ class Zone(object):
         self.__active = active
         if active:
             self.active_since = time.time()
+            self.stats.activated(self.active_since)
             self.smoothed_active = True
         else:
             self.last_active = time.time()
+            self.stats.deactivated(self.last_active, self.last_active - self.active_since)
             self.active_since = None
 
+class AreaIndex(object):
+    """Which zones are in each area (from the zones' areaBitmap), and which
+    of them are active, in tamper or bypassed. The sets are updated as each
+    zone event arrives, touching only the areas the zone is in, so area
+    queries don't have to look at every zone"""
+    def __init__(self):
+        self.zone_areas = {}
+        self.zone_bitmap = {}
+        self.area_zones = collections.defaultdict(set)
+        self.active = collections.defaultdict(set)
+        self.tamper = collections.defaultdict(set)
+        self.bypassed = collections.defaultdict(set)
+        # zones that would stop the area being armed: active or in tamper, and not bypassed
+        self.blocking = collections.defaultdict(set)
+        # area -> state from the last area event
+        self.area_state = {}
+
+    @staticmethod
+    def areas_in_bitmap(area_bitmap):
+        areas = []
+        area = 1
+        while area_bitmap:
+            if area_bitmap & 1:
+                areas.append(area)
+            area_bitmap >>= 1
+            area += 1
+        return tuple(areas)
+
+    def set_zone_areas(self, zone_number, area_bitmap):
+        """Record the areas a zone is in; an area_bitmap of 0 removes it"""
+        bitmap = self.zone_bitmap.get(zone_number, 0)
+        self.update_zone(zone_number, 0)
+        for area in self.zone_areas.pop(zone_number, ()):
+            self.area_zones[area].discard(zone_number)
+        areas = self.areas_in_bitmap(area_bitmap)
+        if areas:
+            self.zone_areas[zone_number] = areas
+            for area in areas:
+                self.area_zones[area].add(zone_number)
+            self.update_zone(zone_number, bitmap)
+
+    def update_zone(self, zone_number, zone_bitmap):
+        """Update the sets from the bitmap in a zone event"""
+        self.zone_bitmap[zone_number] = zone_bitmap
+        state = zone_bitmap & 0x3
+        bypassed = zone_bitmap & 0x60 != 0
+        flags = (
+            (self.active, state == 1),
+            (self.tamper, state >= 2),
+            (self.bypassed, bypassed),
+            (self.blocking, state != 0 and not bypassed),
+        )
+        for area in self.zone_areas.get(zone_number, ()):
+            for zones, present in flags:
+                if present:
+                    zones[area].add(zone_number)
+                else:
+                    zones[area].discard(zone_number)
+
+    def update_area(self, area, area_state):
+        self.area_state[area] = area_state
+
+    def zones(self, area):
+        return frozenset(self.area_zones.get(area, ()))
+
+    def active_count(self, area):
+        return len(self.active.get(area, ()))
+
+    def tamper_count(self, area):
+        return len(self.tamper.get(area, ()))
+
+    def bypassed_count(self, area):
+        return len(self.bypassed.get(area, ()))
+
+    def any_active(self, area):
+        return bool(self.active.get(area))
+
+    def blocking_zones(self, area):
+        return frozenset(self.blocking.get(area, ()))
+
+    def summary(self, area):
+        return {
+            "zones": len(self.area_zones.get(area, ())),
+            "active": self.active_count(area),
+            "tamper": self.tamper_count(area),
+            "bypassed": self.bypassed_count(area),
+            "blocking": sorted(self.blocking.get(area, ())),
+        }
+
+class OutputStates(object):
+    """The last state of each output location (panel outputs, digi
+    outputs, each network keypad and expander's outputs, ...), 8 bits per
+    location, as given by output events"""
+    def __init__(self):
+        self.states = {}
+        # location -> the bits that changed in its last event
+        self.changed = {}
+        # events that changed nothing, so weren't passed on
+        self.unchanged = 0
+
+    def update(self, location, state):
+        """Record the state from an output event, and return the bits it
+        changed; the first event for a location changes all of them"""
+        previous = self.states.get(location)
+        changed = 0xff if previous is None else previous ^ state
+        self.states[location] = state
+        if changed:
+            self.changed[location] = changed
+        else:
+            self.unchanged += 1
+        return changed
+
+    def state(self, location):
+        return self.states.get(location)
+
+class SequenceGaps(object):
+    """Gaps in the sequence numbers of the messages from the panel, i.e.
+    messages that were lost"""
+    def __init__(self, history=32):
+        # (time, first missing sequence number, last missing sequence number) of the most recent gaps
+        self.recent = collections.deque(maxlen=history)
+        self.gaps = 0
+        self.missed = 0
+        # sequence numbers that went backwards, e.g. because the panel restarted
+        self.restarts = 0
+        self.recoveries = 0
+        # log events the panel wrote during gaps that never arrived, as estimated by recover_from_gap
+        self.log_events_missed = 0
+        # recoveries that couldn't tell how many log events were missed, e.g. because the log wrapped round
+        self.log_events_unknown = 0
+
+    def record(self, expected, actual, now):
+        """Record a message with sequence number actual when expected was
+        due. Returns the number of messages missed, or None if the
+        sequence restarted"""
+        missed = (actual - expected) & 0xff
+        if missed >= 128:
+            # too far ahead to be a gap; it's more likely the sequence went backwards
+            self.restarts += 1
+            return None
+        self.recent.append((now, expected, (actual - 1) & 0xff))
+        self.gaps += 1
+        self.missed += missed
+        return missed
+
+    def summary(self):
+        return {
+            "gaps": self.gaps,
+            "missed": self.missed,
+            "restarts": self.restarts,
+            "recoveries": self.recoveries,
+            "log_events_missed": self.log_events_missed,
+            "log_events_unknown": self.log_events_unknown,
+        }
+
+class ZoneDebouncer(object):
+    """Holds back zone events until the zone has settled, so a flapping
+    PIR or door contact gives one change of state rather than dozens.
+
+    delays maps zone type to (activate_delay, deactivate_delay) in seconds:
+    how long the zone must stay in its new state before the event is
+    passed on. Different delays for the two directions give hysteresis;
+    by default zones go active straight away and only going back to
+    secure is held back. An event that is undone before its delay is up is
+    dropped, along with the event that undid it, and both are counted as
+    suppressed flaps."""
+    def __init__(self, delays):
+        self.delays = dict(delays)
+        self.emitted = {}
+        # zone number -> (due time, payload, zone bitmap)
+        self.pending = {}
+        self.suppressed = 0
+        self.flaps = collections.Counter()
+
+    def delay(self, zone_type, zone_bitmap):
+        activate_delay, deactivate_delay = self.delays.get(zone_type, (0, 0))
+        return deactivate_delay if zone_bitmap & 0x3 == 0 else activate_delay
+
+    def event(self, zone_number, zone_type, zone_bitmap, payload, now):
+        """Returns True if the event should be passed on now, otherwise it
+        is held back (or dropped)"""
+        pending = self.pending.get(zone_number)
+        if pending is not None and pending[2] == zone_bitmap:
+            # a repeat of the event being held back; that one is still due when it was
+            return False
+        if pending is not None:
+            # the held back event never settled
+            del self.pending[zone_number]
+            self.suppressed += 1
+            self.flaps[zone_number] += 1
+            if zone_bitmap == self.emitted.get(zone_number):
+                # ... and the zone is back where it was; this event is a flap too
+                self.suppressed += 1
+                return False
+        delay = self.delay(zone_type, zone_bitmap)
+        if delay <= 0:
+            self.emitted[zone_number] = zone_bitmap
+            return True
+        self.pending[zone_number] = (now + delay, payload, zone_bitmap)
+        return False
+
+    def due(self, now):
+        """Remove and return the payloads of the held back events that have settled"""
+        payloads = []
+        for zone_number, (due, payload, zone_bitmap) in list(self.pending.items()):
+            if due <= now:
+                del self.pending[zone_number]
+                self.emitted[zone_number] = zone_bitmap
+                payloads.append((due, payload))
+        return [payload for due, payload in sorted(payloads)]
+
+    def next_due(self):
+        if not self.pending:
+            return None
+        return min(due for due, payload, zone_bitmap in self.pending.values())
+
+class QueryCache(object):
+    """Remembers the answers to panel queries for a short time. Callers
+    asking for a query that is already being sent to the panel wait for
+    that answer rather than sending it again.
+
+    invalidate() bumps the query's generation, so an answer fetched whilst
+    it was being invalidated (e.g. a power reading that was asked for just
+    before an AC fail event arrived) isn't cached"""
+    def __init__(self, ttls):
+        self.ttls = ttls
+        self.values = {}
+        self.generations = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def peek(self, query, max_age=None):
+        """Return the cached answer if it's recent enough, otherwise None"""
+        if max_age is None:
+            max_age = self.ttls.get(query, 0)
+        with self.lock:
+            entry = self.values.get(query)
+            if entry is not None and time.time() - entry[0] <= max_age:
+                self.hits += 1
+                return entry[1]
+        return None
+
+    def get(self, query, fetch, max_age=None, share=True):
+        """Answer query from the cache, or with fetch(). If share is False the
+        caller never waits for another caller's fetch, but fetches it itself"""
+        value = self.peek(query, max_age)
+        if value is not None:
+            return value
+        with self.lock:
+            generation = self.generations.get(query, 0)
+            event = self.in_flight.get(query)
+            if event is not None and not share:
+                self.misses += 1
+            elif event is None:
+                event = threading.Event()
+                event.result = None
+                self.in_flight[query] = event
+                self.misses += 1
+                owner = True
+            else:
+                self.shared += 1
+                owner = False
+        if event is not None and not share:
+            value = fetch()
+            if value is not None:
+                self.put(query, value, generation)
+            return value
+        if not owner:
+            event.wait()
+            return event.result
+        value = None
+        try:
+            value = fetch()
+        finally:
+            with self.lock:
+                del self.in_flight[query]
+                event.result = value
+                if value is not None and generation == self.generations.get(query, 0):
+                    self.values[query] = (time.time(), value)
+            event.set()
+        return value
+
+    def generation(self, query):
+        with self.lock:
+            return self.generations.get(query, 0)
+
+    def put(self, query, value, generation=None):
+        """Cache value, unless the query has been invalidated since
+        generation() returned generation"""
+        with self.lock:
+            if generation is None or generation == self.generations.get(query, 0):
+                self.values[query] = (time.time(), value)
+
+    def invalidate(self, query):
+        with self.lock:
+            self.values.pop(query, None)
+            self.generations[query] = self.generations.get(query, 0) + 1
+
+class DecodeCache(object):
+    """Bounded LRU cache of the text decode_message_to_text gives for each
+    payload. The text includes zone, area and user names, so it must be
+    cleared whenever those change. Messages are only decoded on the thread
+    talking to the panel, so there's no locking; a lock would cost more
+    than the lookup"""
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # messages that aren't worth caching, see decode_message_to_text
+        self.bypassed = 0
+
+    def get(self, key):
+        text = self.entries.get(key)
+        if text is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return text
+
+    def put(self, key, text):
+        self.entries[key] = text
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+class ScheduledCommand(object):
+    def __init__(self, priority, func, args):
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.result = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait for the command to be run and return its result; None if it
+        failed, was cancelled or didn't finish in time"""
+        self.done.wait(timeout)
+        return self.result
+
+
+class CommandScheduler(object):
+    """Queue of work that needs to talk to the panel. Any thread may submit
+    work; it is run, most urgent first, by the thread that owns the panel
+    connection. The scheduler can be passed to select() to wake that thread
+    up when work is submitted"""
+    INTERACTIVE = 0
+    KEEPALIVE = 1
+    BULK = 2
+
+    def __init__(self, max_bulk_burst=5):
+        # how many bulk commands may run back to back before we go back to
+        # reading events from the panel and looking for more urgent work
+        self.max_bulk_burst = max_bulk_burst
+        self.queue = []
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.wakeup_read
+
+    def submit(self, priority, func, *args):
+        command = ScheduledCommand(priority, func, args)
+        with self.lock:
+            heapq.heappush(self.queue, (priority, next(self.order), command))
+        try:
+            os.write(self.wakeup_write, b"x")
+        except OSError:
+            # pipe is full, so the owning thread has plenty of wake ups waiting already
+            pass
+        return command
+
+    def pending(self):
+        with self.lock:
+            return len(self.queue)
+
+    def pending_priority(self, priority):
+        with self.lock:
+            return sum(1 for entry in self.queue if entry[0] == priority)
+
+    def run(self):
+        """Run queued commands until there are none left or the bulk burst
+        limit is reached. Returns the number of commands run"""
+        try:
+            while os.read(self.wakeup_read, 512):
+                pass
+        except OSError:
+            pass
+        ran = 0
+        bulk_run = 0
+        while True:
+            with self.lock:
+                if not self.queue:
+                    break
+                if self.queue[0][0] == self.BULK and bulk_run >= self.max_bulk_burst:
+                    break
+                priority, _, command = heapq.heappop(self.queue)
+            if priority == self.BULK:
+                bulk_run += 1
+            ran += 1
+            try:
+                command.result = command.func(*command.args)
+            finally:
+                command.done.set()
+        return ran
+
+    def cancel(self):
+        """Drop everything queued, e.g. because the connection has been lost"""
+        with self.lock:
+            queue, self.queue = self.queue, []
+        for _, _, command in queue:
+            command.done.set()
+
+# runs of characters panel text is cleaned of
+NON_WORD = re.compile(r'\W+')
+# panel text is 8 bit; latin-1 maps every byte to a character, so nothing is lost decoding it
+PANEL_ENCODING = "latin-1"
+
+
+def response_layouts(*formats):
+    """Compile the struct formats a response to one command can have,
+    keyed by the length of response each one decodes"""
+    return dict((struct.calcsize(fmt), struct.Struct(fmt)) for fmt in formats)
+
+
 class TexecomConnect(object):
     LENGTH_HEADER = 4
-    HEADER_START = 't'
-    HEADER_TYPE_COMMAND = 'C'
-    HEADER_TYPE_RESPONSE = 'R'
-    HEADER_TYPE_MESSAGE = 'M'  # unsolicited message
-
-    CMD_LOGIN = chr(1)
-    CMD_GETZONEDETAILS = chr(3)
-    CMD_GETLCDDISPLAY = chr(13)
-    CMD_GETLOGPOINTER = chr(15)
-    CMD_GETPANELIDENTIFICATION = chr(22)
-    CMD_GETDATETIME = chr(23)
-    CMD_GETSYSTEMPOWER = chr(25)
-    CMD_GETUSER = chr(27)
-    CMD_GETAREADETAILS = chr(35)
-    CMD_SETEVENTMESSAGES = chr(37)
+    # frames are at most this long, as the length is a single byte
+    MAX_FRAME = 255
+    HEADER_START = ord('t')
+    HEADER_TYPE_COMMAND = ord('C')
+    HEADER_TYPE_RESPONSE = ord('R')
+    HEADER_TYPE_MESSAGE = ord('M')  # unsolicited message
+    # start, type, length, sequence number and command of a command frame
+    COMMAND_HEADER = struct.Struct("<BBBBB")
+
+    CMD_LOGIN = 1
+    CMD_GETZONEDETAILS = 3
+    CMD_GETLCDDISPLAY = 13
+    CMD_GETLOGPOINTER = 15
+    CMD_GETPANELIDENTIFICATION = 22
+    CMD_GETDATETIME = 23
+    CMD_GETSYSTEMPOWER = 25
+    CMD_GETUSER = 27
+    CMD_GETAREADETAILS = 35
+    CMD_SETEVENTMESSAGES = 37
 
     # 2-3 seconds is mentioned in section 5.5 of protocol specification
     # Increasing this value is not recommended as it will mean if the
@@ -137,200 +680,272 @@ class TexecomConnect(object):
 
     ZONETYPE_UNUSED = 0
 
-    CMD_RESPONSE_ACK = '\x06'
-    CMD_RESPONSE_NAK = '\x15'
-
-    MSG_DEBUG = chr(0)
-    MSG_ZONEEVENT = chr(1)
-    MSG_AREAEVENT = chr(2)
-    MSG_OUTPUTEVENT = chr(3)
-    MSG_USEREVENT = chr(4)
-    MSG_LOGEVENT = chr(5)
-
-    zone_types = {}
-    zone_types[1] = "Entry/Exit 1"
-    zone_types[2] = "Entry/Exit 2"
-    zone_types[3] = "Interior"
-    zone_types[4] = "Perimeter"
-    zone_types[5] = "24hr Audible"
-    zone_types[6] = "24hr Silent"
-    zone_types[7] = "Audible PA"
-    zone_types[8] = "Silent PA"
-    zone_types[9] = "Fire Alarm"
-    zone_types[10] = "Medical"
-    zone_types[11] = "24Hr Gas Alarm"
-    zone_types[12] = "Auxiliary Alarm"
-    zone_types[13] = "24hr Tamper Alarm"
-    zone_types[14] = "Exit Terminator"
-    zone_types[15] = "Keyswitch - Momentary"
-    zone_types[16] = "Keyswitch - Latching"
-    zone_types[17] = "Security Key"
-    zone_types[18] = "Omit Key"
-    zone_types[19] = "Custom Alarm"
-    zone_types[20] = "Confirmed PA Audible"
-    zone_types[21] = "Confirmed PA Audible"
-
-    log_event_types = {}
-    log_event_types[1] = "Entry/Exit 1"
-    log_event_types[2] = "Entry/Exit 2"
-    log_event_types[3] = "Interior"
-    log_event_types[4] = "Perimeter"
-    log_event_types[5] = "24hr Audible"
-    log_event_types[6] = "24hr Silent"
-    log_event_types[7] = "Audible PA"
-    log_event_types[8] = "Silent PA"
-    log_event_types[9] = "Fire Alarm"
-    log_event_types[10] = "Medical"
-    log_event_types[11] = "24Hr Gas Alarm"
-    log_event_types[12] = "Auxiliary Alarm"
-    log_event_types[13] = "24hr Tamper Alarm"
-    log_event_types[14] = "Exit Terminator"
-    log_event_types[15] = "Keyswitch - Momentary"
-    log_event_types[16] = "Keyswitch - Latching"
-    log_event_types[17] = "Security Key"
-    log_event_types[18] = "Omit Key"
-    log_event_types[19] = "Custom Alarm"
-    log_event_types[20] = "Confirmed PA Audible"
-    log_event_types[21] = "Confirmed PA Audible"
-    log_event_types[22] = "Keypad Medical"
-    log_event_types[23] = "Keypad Fire"
-    log_event_types[24] = "Keypad Audible PA"
-    log_event_types[25] = "Keypad Silent PA"
-    log_event_types[26] = "Duress Code Alarm"
-    log_event_types[27] = "Alarm Active"
-    log_event_types[28] = "Bell Active"
-    log_event_types[29] = "Re-arm"
-    log_event_types[30] = "Verified Cross Zone Alarm"
-    log_event_types[31] = "User Code"
-    log_event_types[32] = "Exit Started"
-    log_event_types[33] = "Exit Error (Arming Failed)"
-    log_event_types[34] = "Entry Started"
-    log_event_types[35] = "Part Arm Suite"
-    log_event_types[36] = "Armed with Line Fault"
-    log_event_types[37] = "Open/Close (Away Armed)"
-    log_event_types[38] = "Part Armed"
-    log_event_types[39] = "Auto Open/Close"
-    log_event_types[40] = "Auto Arm Deferred"
-    log_event_types[41] = "Open After Alarm (Alarm Abort)"
-    log_event_types[42] = "Remote Open/Close"
-    log_event_types[43] = "Quick Arm"
-    log_event_types[44] = "Recent Closing"
-    log_event_types[45] = "Reset After Alarm"
-    log_event_types[46] = "Power O/P Fault"
-    log_event_types[47] = "AC Fail"
-    log_event_types[48] = "Low Battery"
-    log_event_types[49] = "System Power Up"
-    log_event_types[50] = "Mains Over Voltage"
-    log_event_types[51] = "Telephone Line Fault"
-    log_event_types[52] = "Fail to Communicate"
-    log_event_types[53] = "Download Start"
-    log_event_types[54] = "Download End"
-    log_event_types[55] = "Log Capacity Alert (80%)"
-    log_event_types[56] = "Date Changed"
-    log_event_types[57] = "Time Changed"
-    log_event_types[58] = "Installer Programming Start"
-    log_event_types[59] = "Installer Programming End"
-    log_event_types[60] = "Panel Box Tamper"
-    log_event_types[61] = "Bell Tamper"
-    log_event_types[62] = "Auxiliary Tamper"
-    log_event_types[63] = "Expander Tamper"
-    log_event_types[64] = "Keypad Tamper"
-    log_event_types[65] = "Expander Trouble (Network error)"
-    log_event_types[66] = "Remote Keypad Trouble (Network error)"
-    log_event_types[67] = "Fire Zone Tamper"
-    log_event_types[68] = "Zone Tamper"
-    log_event_types[69] = "Keypad Lockout"
-    log_event_types[70] = "Code Tamper Alarm"
-    log_event_types[71] = "Soak Test Alarm"
-    log_event_types[72] = "Manual Test Transmission"
-    log_event_types[73] = "Automatic Test Transmission"
-    log_event_types[74] = "User Walk Test Start/End"
-    log_event_types[75] = "NVM Defaults Loaded"
-    log_event_types[76] = "First Knock"
-    log_event_types[77] = "Door Access"
-    log_event_types[78] = "Part Arm 1"
-    log_event_types[79] = "Part Arm 2"
-    log_event_types[80] = "Part Arm 3"
-    log_event_types[81] = "Auto Arming Started"
-    log_event_types[82] = "Confirmed Alarm"
-    log_event_types[83] = "Prox Tag"
-    log_event_types[84] = "Access Code Changed/Deleted"
-    log_event_types[85] = "Arm Failed"
-    log_event_types[86] = "Log Cleared"
-    log_event_types[87] = "iD Loop Shorted"
-    log_event_types[88] = "Communication Port"
-    log_event_types[89] = "TAG System Exit (Batt. OK)"
-    log_event_types[90] = "TAG System Exit (Batt. LOW)"
-    log_event_types[91] = "TAG System Entry (Batt. OK)"
-    log_event_types[92] = "TAG System Entry (Batt. LOW)"
-    log_event_types[93] = "Microphone Activated"
-    log_event_types[94] = "AV Cleared Down"
-    log_event_types[95] = "Monitored Alarm"
-    log_event_types[96] = "Expander Low Voltage"
-    log_event_types[97] = "Supervision Fault"
-    log_event_types[98] = "PA from Remote FOB"
-    log_event_types[99] = "RF Device Low Battery"
-    log_event_types[100] = "Site Data Changed"
-    log_event_types[101] = "Radio Jamming"
-    log_event_types[102] = "Test Call Passed"
-    log_event_types[103] = "Test Call Failed"
-    log_event_types[104] = "Zone Fault"
-    log_event_types[105] = "Zone Masked"
-    log_event_types[106] = "Faults Overridden"
-    log_event_types[107] = "PSU AC Fail"
-    log_event_types[108] = "PSU Battery Fail"
-    log_event_types[109] = "PSU Low Output Fail"
-    log_event_types[110] = "PSU Tamper"
-    log_event_types[111] = "Door Access"
-    log_event_types[112] = "CIE Reset"
-    log_event_types[113] = "Remote Command"
-    log_event_types[114] = "User Added"
-    log_event_types[115] = "User Deleted"
-    log_event_types[116] = "Confirmed PA"
-    log_event_types[117] = "User Acknowledged"
-    log_event_types[118] = "Power Unit Failure"
-    log_event_types[119] = "Battery Charger Fault"
-    log_event_types[120] = "Confirmed Intruder"
-    log_event_types[121] = "GSM Tamper"
-    log_event_types[122] = "Radio Config. Failure"
-
-    log_event_group_type = {}
-    log_event_group_type[0] = "Not Reported"
-    log_event_group_type[1] = "Priority Alarm"
-    log_event_group_type[2] = "Priority Alarm Restore"
-    log_event_group_type[3] = "Alarm"
-    log_event_group_type[4] = "Restore"
-    log_event_group_type[5] = "Open"
-    log_event_group_type[6] = "Close"
-    log_event_group_type[7] = "Bypassed"
-    log_event_group_type[8] = "Unbypassed"
-    log_event_group_type[9] = "Maintenance Alarm"
-    log_event_group_type[10] = "Maintenance Restore"
-    log_event_group_type[11] = "Tamper Alarm"
-    log_event_group_type[12] = "Tamper Restore"
-    log_event_group_type[13] = "Test Start"
-    log_event_group_type[14] = "Test End"
-    log_event_group_type[15] = "Disarmed"
-    log_event_group_type[16] = "Armed"
-    log_event_group_type[17] = "Tested"
-    log_event_group_type[18] = "Started"
-    log_event_group_type[19] = "Ended"
-    log_event_group_type[20] = "Fault"
-    log_event_group_type[21] = "Omitted"
-    log_event_group_type[22] = "Reinstated"
-    log_event_group_type[23] = "Stopped"
-    log_event_group_type[24] = "Start"
-    log_event_group_type[25] = "Deleted"
-    log_event_group_type[26] = "Active"
-    log_event_group_type[27] = "Not Used"
-    log_event_group_type[28] = "Changed"
-    log_event_group_type[29] = "Low Battery"
-    log_event_group_type[30] = "Radio"
-    log_event_group_type[31] = "Deactivated"
-    log_event_group_type[32] = "Added"
-    log_event_group_type[33] = "Bad Action"
-    log_event_group_type[34] = "PA Timer Reset"
-    log_event_group_type[35] = "PA Zone Lockout"
+    # how the responses to each query are laid out, for each length the panel
+    # may answer with; a new panel variant only needs its format adding here
+    RESPONSE_LAYOUTS = {
+        # zone type, area bitmap (1, 2 or 8 bytes depending on the panel), text
+        CMD_GETZONEDETAILS: response_layouts("<BB32s", "<BH32s", "<BQ32s"),
+        # area number, text, exit delay, entry 1 delay, entry 2 delay, second entry
+        CMD_GETAREADETAILS: response_layouts("<B16sHHHH"),
+        # name, passcode, areas, modifiers, locks, doors, tag, config
+        CMD_GETUSER: response_layouts("<8s3sBcc3s4sH"),
+        # reference, system and battery voltage, system and battery current
+        CMD_GETSYSTEMPOWER: response_layouts("<5B"),
+        CMD_GETLOGPOINTER: response_layouts("<H"),
+    }
+
+    CMD_RESPONSE_ACK = b'\x06'
+    CMD_RESPONSE_NAK = b'\x15'
+
+    MSG_DEBUG = 0
+    MSG_ZONEEVENT = 1
+    MSG_AREAEVENT = 2
+    MSG_OUTPUTEVENT = 3
+    MSG_USEREVENT = 4
+    MSG_LOGEVENT = 5
+
+    # SETEVENTMESSAGES flag for each type of message
+    EVENT_FLAGS = {
+        MSG_DEBUG: 1,
+        MSG_ZONEEVENT: 1 << 1,
+        MSG_AREAEVENT: 1 << 2,
+        MSG_OUTPUTEVENT: 1 << 3,
+        MSG_USEREVENT: 1 << 4,
+        MSG_LOGEVENT: 1 << 5,
+    }
+    # the messages asked for when there is a message_handler_func or sink, which get everything
+    ALL_EVENTS = (MSG_ZONEEVENT, MSG_AREAEVENT, MSG_OUTPUTEVENT, MSG_USEREVENT, MSG_LOGEVENT)
+
+    # (activate_delay, deactivate_delay) in seconds for each zone type, see ZoneDebouncer;
+    # zone types not listed (alarms, PA, fire etc) are never held back
+    ZONE_DEBOUNCE = {
+        1: (0, 1),  # Entry/Exit 1
+        2: (0, 1),  # Entry/Exit 2
+        3: (0, 2),  # Interior
+        4: (0, 1),  # Perimeter
+    }
+
+    # after restoring a checkpoint, how long to wait before re-reading the site data in the background
+    WARM_RESTART_REFRESH_DELAY = 120
+
+    # how long, in seconds, cached_query() may answer these queries from the cache
+    QUERY_CACHE_TTL = {
+        "get_date_time": 30,
+        "get_lcd_display": 1,
+        "get_log_pointer": 5,
+        "get_system_power": 10,
+    }
+    # how long another thread's cached_query() waits for its query to be sent: any command already
+    # being sent, with its retries, and then this one
+    QUERY_WAIT = 2 * CMD_TIMEOUT * CMD_RETRIES
+    # how many decoded messages to remember, see DecodeCache
+    DECODE_CACHE_SIZE = 1024
+    # log event types that mean a cached query answer is out of date
+    LOG_EVENT_INVALIDATES = {
+        46: "get_system_power",  # Power O/P Fault
+        47: "get_system_power",  # AC Fail
+        48: "get_system_power",  # Low Battery
+        49: "get_system_power",  # System Power Up
+        50: "get_system_power",  # Mains Over Voltage
+        56: "get_date_time",  # Date Changed
+        57: "get_date_time",  # Time Changed
+        107: "get_system_power",  # PSU AC Fail
+        108: "get_system_power",  # PSU Battery Fail
+        109: "get_system_power",  # PSU Low Output Fail
+        118: "get_system_power",  # Power Unit Failure
+        119: "get_system_power",  # Battery Charger Fault
+    }
+
+    PANEL_AREAS = {12: 2, 24: 2, 48: 4, 64: 4, 88: 8, 168: 16, 640: 64}
+    PANEL_USERS = {12: 8, 24: 25, 48: 50, 64: 50, 88: 100, 168: 200, 640: 1000}
+
+    zone_types = {
+        1: "Entry/Exit 1",
+        2: "Entry/Exit 2",
+        3: "Interior",
+        4: "Perimeter",
+        5: "24hr Audible",
+        6: "24hr Silent",
+        7: "Audible PA",
+        8: "Silent PA",
+        9: "Fire Alarm",
+        10: "Medical",
+        11: "24Hr Gas Alarm",
+        12: "Auxiliary Alarm",
+        13: "24hr Tamper Alarm",
+        14: "Exit Terminator",
+        15: "Keyswitch - Momentary",
+        16: "Keyswitch - Latching",
+        17: "Security Key",
+        18: "Omit Key",
+        19: "Custom Alarm",
+        20: "Confirmed PA Audible",
+        21: "Confirmed PA Audible",
+    }
+
+    log_event_types = {
+        1: "Entry/Exit 1",
+        2: "Entry/Exit 2",
+        3: "Interior",
+        4: "Perimeter",
+        5: "24hr Audible",
+        6: "24hr Silent",
+        7: "Audible PA",
+        8: "Silent PA",
+        9: "Fire Alarm",
+        10: "Medical",
+        11: "24Hr Gas Alarm",
+        12: "Auxiliary Alarm",
+        13: "24hr Tamper Alarm",
+        14: "Exit Terminator",
+        15: "Keyswitch - Momentary",
+        16: "Keyswitch - Latching",
+        17: "Security Key",
+        18: "Omit Key",
+        19: "Custom Alarm",
+        20: "Confirmed PA Audible",
+        21: "Confirmed PA Audible",
+        22: "Keypad Medical",
+        23: "Keypad Fire",
+        24: "Keypad Audible PA",
+        25: "Keypad Silent PA",
+        26: "Duress Code Alarm",
+        27: "Alarm Active",
+        28: "Bell Active",
+        29: "Re-arm",
+        30: "Verified Cross Zone Alarm",
+        31: "User Code",
+        32: "Exit Started",
+        33: "Exit Error (Arming Failed)",
+        34: "Entry Started",
+        35: "Part Arm Suite",
+        36: "Armed with Line Fault",
+        37: "Open/Close (Away Armed)",
+        38: "Part Armed",
+        39: "Auto Open/Close",
+        40: "Auto Arm Deferred",
+        41: "Open After Alarm (Alarm Abort)",
+        42: "Remote Open/Close",
+        43: "Quick Arm",
+        44: "Recent Closing",
+        45: "Reset After Alarm",
+        46: "Power O/P Fault",
+        47: "AC Fail",
+        48: "Low Battery",
+        49: "System Power Up",
+        50: "Mains Over Voltage",
+        51: "Telephone Line Fault",
+        52: "Fail to Communicate",
+        53: "Download Start",
+        54: "Download End",
+        55: "Log Capacity Alert (80%)",
+        56: "Date Changed",
+        57: "Time Changed",
+        58: "Installer Programming Start",
+        59: "Installer Programming End",
+        60: "Panel Box Tamper",
+        61: "Bell Tamper",
+        62: "Auxiliary Tamper",
+        63: "Expander Tamper",
+        64: "Keypad Tamper",
+        65: "Expander Trouble (Network error)",
+        66: "Remote Keypad Trouble (Network error)",
+        67: "Fire Zone Tamper",
+        68: "Zone Tamper",
+        69: "Keypad Lockout",
+        70: "Code Tamper Alarm",
+        71: "Soak Test Alarm",
+        72: "Manual Test Transmission",
+        73: "Automatic Test Transmission",
+        74: "User Walk Test Start/End",
+        75: "NVM Defaults Loaded",
+        76: "First Knock",
+        77: "Door Access",
+        78: "Part Arm 1",
+        79: "Part Arm 2",
+        80: "Part Arm 3",
+        81: "Auto Arming Started",
+        82: "Confirmed Alarm",
+        83: "Prox Tag",
+        84: "Access Code Changed/Deleted",
+        85: "Arm Failed",
+        86: "Log Cleared",
+        87: "iD Loop Shorted",
+        88: "Communication Port",
+        89: "TAG System Exit (Batt. OK)",
+        90: "TAG System Exit (Batt. LOW)",
+        91: "TAG System Entry (Batt. OK)",
+        92: "TAG System Entry (Batt. LOW)",
+        93: "Microphone Activated",
+        94: "AV Cleared Down",
+        95: "Monitored Alarm",
+        96: "Expander Low Voltage",
+        97: "Supervision Fault",
+        98: "PA from Remote FOB",
+        99: "RF Device Low Battery",
+        100: "Site Data Changed",
+        101: "Radio Jamming",
+        102: "Test Call Passed",
+        103: "Test Call Failed",
+        104: "Zone Fault",
+        105: "Zone Masked",
+        106: "Faults Overridden",
+        107: "PSU AC Fail",
+        108: "PSU Battery Fail",
+        109: "PSU Low Output Fail",
+        110: "PSU Tamper",
+        111: "Door Access",
+        112: "CIE Reset",
+        113: "Remote Command",
+        114: "User Added",
+        115: "User Deleted",
+        116: "Confirmed PA",
+        117: "User Acknowledged",
+        118: "Power Unit Failure",
+        119: "Battery Charger Fault",
+        120: "Confirmed Intruder",
+        121: "GSM Tamper",
+        122: "Radio Config. Failure",
+    }
+
+    log_event_group_type = {
+        0: "Not Reported",
+        1: "Priority Alarm",
+        2: "Priority Alarm Restore",
+        3: "Alarm",
+        4: "Restore",
+        5: "Open",
+        6: "Close",
+        7: "Bypassed",
+        8: "Unbypassed",
+        9: "Maintenance Alarm",
+        10: "Maintenance Restore",
+        11: "Tamper Alarm",
+        12: "Tamper Restore",
+        13: "Test Start",
+        14: "Test End",
+        15: "Disarmed",
+        16: "Armed",
+        17: "Tested",
+        18: "Started",
+        19: "Ended",
+        20: "Fault",
+        21: "Omitted",
+        22: "Reinstated",
+        23: "Stopped",
+        24: "Start",
+        25: "Deleted",
+        26: "Active",
+        27: "Not Used",
+        28: "Changed",
+        29: "Low Battery",
+        30: "Radio",
+        31: "Deactivated",
+        32: "Added",
+        33: "Bad Action",
+        34: "PA Timer Reset",
+        35: "PA Zone Lockout",
+    }
 
     def __init__(self, host, port, udl_password, message_handler_func):
         self.host = host
@@ -339,11 +954,39 @@ class TexecomConnect(object):
         self.crc8_func = crcmod.mkCrcFun(poly=0x185, rev=False, initCrc=0xff)
         self.nextseq = 0
         self.message_handler_func = message_handler_func
-        self.print_network_traffic = False
+        self.trace = FrameTrace()
+        self.capture = None
+        # texecomProfile.Profiler, kept whilst profiling is turned off so it can still be dumped
+        self.profiler = None
+        # the profiler when profiling is on, otherwise None; checked before each stage of work
+        self.active_profiler = None
+        self.notifier = None
+        self.sinks = None
+        self.state_export = None
+        self.checkpoint_file = None
+        self.checkpoint_interval = 60
+        self.last_checkpoint = 0
+        self.checkpoint_dirty = False
+        # (panel type, number of zones) from a checkpoint restored at startup, until the panel is checked
+        self.restored_panel = None
+        # when to re-read the site data after a warm restart
+        self.site_data_refresh_at = None
+        # msg_type -> [(func, zone/area numbers or None for all)], see subscribe()
+        self.subscribers = {}
+        # msg_type -> zone/area numbers or None for all, or None if every message is wanted
+        self.message_filter = None
         self.last_command_time = 0
         self.last_received_seq = -1
+        self.sequence_gaps = SequenceGaps()
+        self.gap_recovery_queued = False
+        # the last log pointer read, and how many log events have arrived since
+        self.log_pointer = None
+        self.log_events_since_pointer = 0
         self.last_sequence = -1
         self.last_command = None
+        # frames are received into, and commands assembled in, these rather than new strings for each frame
+        self.receive_buffer = memoryview(bytearray(self.MAX_FRAME))
+        self.send_buffer = bytearray(self.MAX_FRAME)
         self.panelType = None
         self.firmwareVersion = None
         self.numberOfZones = -1
@@ -351,20 +994,131 @@ class TexecomConnect(object):
         self.user = {}
         self.area = {}
         self.s = None
+        # the thread talking to the panel; other threads' commands have to go through the scheduler
+        self.panel_thread = None
         # used to record which of our idle commands we last sent to the panel
         self.lastIdleCommand = 0
         # Set to true if the idle loop should reread the site data
         self.siteDataChanged = False
+        self.query_cache = QueryCache(self.QUERY_CACHE_TTL)
+        self.decode_cache = DecodeCache(self.DECODE_CACHE_SIZE)
+        self.scheduler = CommandScheduler()
+        self.area_index = AreaIndex()
+        self.outputs = OutputStates()
+        self.debouncer = ZoneDebouncer(self.ZONE_DEBOUNCE)
+
+    @property
+    def print_network_traffic(self):
+        """Print every frame sent or received; they are formatted and printed
+        by a background thread so the panel connection isn't slowed down"""
+        return self.trace.printer is not None
+
+    @print_network_traffic.setter
+    def print_network_traffic(self, enabled):
+        if enabled:
+            self.trace.start_printing()
+        else:
+            self.trace.stop_printing()
+
+    @property
+    def profiling(self):
+        """Count and time the stages of handling the panel's frames, see
+        texecomProfile.py"""
+        return self.active_profiler is not None
+
+    @profiling.setter
+    def profiling(self, enabled):
+        if enabled and self.profiler is None:
+            from texecomProfile import Profiler
+            self.profiler = Profiler()
+        self.active_profiler = self.profiler if enabled else None
+
+    def enable_profile_signals(self, filename):
+        """Turn profiling on and off with SIGUSR1, and write a flame graph
+        of it to filename with SIGUSR2, see texecomProfile.py"""
+        from texecomProfile import enable_signals
+        enable_signals(self, filename)
+
+    def start_capture(self, filename):
+        """Write all traffic with the panel to a pcap file, see texecomPcap.py"""
+        from texecomPcap import PcapWriter
+        self.capture = PcapWriter(filename, self.host, self.port)
+        self.trace.listeners.append(self.capture.write_frame)
+        # write out whatever is still buffered when we exit
+        atexit.register(self.capture.close)
+
+    def notify(self, message):
+        """Send a notification (e.g. connection lost) without waiting for it
+        to be delivered; backends are configured from the environment, see
+        texecomNotify.py"""
+        if self.notifier is None:
+            from texecomNotify import notifier_from_environment
+            self.notifier = notifier_from_environment(self.log)
+        self.notifier.notify(message)
+
+    def add_sink(self, sink):
+        """Pass every message from the panel to sink (see texecomSinks.py),
+        which delivers it from its own thread"""
+        if self.sinks is None:
+            from texecomSinks import SinkPipeline
+            self.sinks = SinkPipeline(self.log)
+        self.sinks.add(sink)
+
+    def start_http_server(self, address):
+        """Serve the zones, areas, users, power readings and link status,
+        and a stream of messages, over HTTP on address (host:port or a unix
+        socket path); see texecomHttp.py"""
+        from texecomHttp import StateServer
+        from texecomProxy import make_listen_socket
+        self.add_sink(StateServer(self, make_listen_socket(address)))
+
+    def start_state_export(self, filename):
+        """Keep zone/area states, power readings and link status in a
+        memory-mapped file for other processes to read, see texecomShm.py"""
+        from texecomShm import StateExport
+        self.state_export = StateExport(filename)
+        for zone in self.zone.values():
+            if hasattr(zone, "zoneType"):
+                self.state_export.zone_type(zone.number, zone.zoneType)
+        for zone_number, zone_bitmap in self.area_index.zone_bitmap.items():
+            self.state_export.zone(zone_number, zone_bitmap)
+        for area_number, area_state in self.area_index.area_state.items():
+            self.state_export.area(area_number, area_state)
+        self.state_export.link(self.s is not None)
+
+    def enable_checkpoints(self, filename, interval=60):
+        """Restore the zones, areas, users and zone states from filename, if
+        it exists, and save them to it every interval seconds when they've
+        changed. Call before connecting"""
+        from texecomCheckpoint import load_checkpoint
+        self.checkpoint_file = filename
+        self.checkpoint_interval = interval
+        saved = load_checkpoint(self, filename)
+        if saved is not None:
+            self.log("Restored {:d} zones, {:d} areas and {:d} users from checkpoint saved at {}".format(
+                len(self.zone), len(self.area), len(self.user), time.strftime("%Y-%m-%d %X", time.localtime(saved))))
+            self.restored_panel = (self.panelType, self.numberOfZones)
+        self.last_checkpoint = time.time()
+
+    def save_checkpoint(self):
+        from texecomCheckpoint import save_checkpoint
+        self.checkpoint_dirty = False
+        self.last_checkpoint = time.time()
+        try:
+            save_checkpoint(self, self.checkpoint_file)
+        except (IOError, OSError) as e:
+            self.log("Failed to save checkpoint - {}".format(e))
 
     @staticmethod
     def hexstr(s):
         """Convert a binary string into a hex representation suitable for logging payloads etc"""
-        return " ".join("{:02x}".format(ord(c)) for c in s)
+        return " ".join("{:02x}".format(b) for b in s)
 
     def connect(self):
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.settimeout(self.CMD_TIMEOUT)
         self.s.connect((self.host, self.port))
+        self.trace.record(self.trace.CONNECTED, b"")
         # if we send the login message to fast the panel ignores it; texecom
         # recommend 500ms, see:
         # http://texecom.websitetoolbox.com/post/show_single_post?pid=1303528828&postcount=4&forum=627911
@@ -385,122 +1139,336 @@ class TexecomConnect(object):
                 pass
             self.s.close()
             self.s = None
+        self.scheduler.cancel()
+        # a recovery that was queued has just been dropped, so the next gap needs to queue another
+        self.gap_recovery_queued = False
+        if self.profiler is not None:
+            # any stages in progress end with an exception, so won't be stopped
+            self.profiler.abandon()
+        if self.state_export is not None:
+            self.state_export.link(False)
+
+    def keepalive(self):
+        """Send one of our idle commands to reset the panel's 60 second timeout.
+        Returns False (and closes the socket) if the panel didn't answer"""
+        if self.lastIdleCommand == 0:
+            result = self.get_date_time()
+        elif self.lastIdleCommand == 1:
+            result = self.get_log_pointer()
+        else:
+            result = self.get_system_power()
+        self.lastIdleCommand += 1
+        if self.lastIdleCommand == 3:
+            self.lastIdleCommand = 0
+        if result is None:
+            self.log("idle command failed; closing socket")
+            self.closesocket()
+            return False
+        return True
+
+    def recvframe(self):
+        """Receive a single frame from the panel and check its header, CRC
+        and sequence number. Returns a (msg_type, payload) tuple, with a
+        msg_type of None if the frame should be ignored, or None if nothing
+        more can be read.
+
+        The payload is a memoryview of the frame, which is copied out of the
+        receive buffer once; keep it, or slices of it, as long as you like"""
+        buf = self.receive_buffer
+        profiler = self.active_profiler
+        if profiler is not None:
+            depth = profiler.start("recv")
+        try:
+            received = self.s.recv_into(buf[:self.LENGTH_HEADER])
+        finally:
+            if profiler is not None:
+                profiler.stop(depth)
+        header = buf[:received]
+        if header == b"+++":
+            self.log("Panel has forcibly dropped connection, possibly due to inactivity")
+            self.closesocket()
+            return None
+        if header == b"+++A":
+            self.log("Panel is trying to hangup modem; probably connected too soon")
+            self.closesocket()
+            return None
+        if received == 0:
+            self.log("Panel has closed connection")
+            self.closesocket()
+            return None
+        if received < self.LENGTH_HEADER:
+            self.trace.record(self.trace.RECEIVED, header.tobytes())
+            self.log("Header received from panel is too short, only {:d} bytes, ignoring - contents {}".format(
+                received, self.hexstr(header)))
+            self.trace.dump(self.log)
+            return None, None
+        msg_start, msg_type, msg_length, msg_sequence = header
+        if msg_start != self.HEADER_START:
+            self.trace.record(self.trace.RECEIVED, header.tobytes())
+            self.log("unexpected msg start: " + hex(msg_start))
+            self.trace.dump(self.log)
+            return None
+        if msg_length <= self.LENGTH_HEADER:
+            self.trace.record(self.trace.RECEIVED, header.tobytes())
+            self.log("Ignoring message, length {:d} is too short for a frame".format(msg_length))
+            self.trace.dump(self.log)
+            return None, None
+        expected_len = msg_length - self.LENGTH_HEADER
+        if profiler is not None:
+            depth = profiler.start("recv")
+        try:
+            received += self.s.recv_into(buf[self.LENGTH_HEADER:msg_length])
+        finally:
+            if profiler is not None:
+                profiler.stop(depth)
+        frame = buf[:received].tobytes()
+        self.trace.record(self.trace.RECEIVED, frame)
+        if received < msg_length:
+            self.log(
+                "Ignoring message, payload shorter than expected - got {:d} bytes, expected {:d} - contents {}".format(
+                    received - self.LENGTH_HEADER, expected_len, self.hexstr(frame[self.LENGTH_HEADER:])))
+            self.trace.dump(self.log)
+            return None, None
+        frame = memoryview(frame)
+        payload, msg_crc = frame[self.LENGTH_HEADER:-1], frame[-1]
+        if profiler is not None:
+            depth = profiler.start("crc")
+        expected_crc = self.crc8_func(frame[:-1])
+        if profiler is not None:
+            profiler.stop(depth)
+        if msg_crc != expected_crc:
+            self.log("crc: expected=" + str(expected_crc) + " actual=" + str(msg_crc))
+            self.trace.dump(self.log)
+            return None
+        if msg_type == self.HEADER_TYPE_RESPONSE:
+            if msg_sequence != self.last_sequence:
+                self.log(
+                    "incorrect response seq: expected=" + str(self.last_sequence) + " actual=" + str(msg_sequence))
+                # recv again - either we receive the correct reply in the next packet, or we'll time out and retry the command
+                return None, None
+        elif msg_type == self.HEADER_TYPE_MESSAGE:
+            if self.last_received_seq != -1:
+                next_msg_seq = self.last_received_seq + 1
+                if next_msg_seq == 256:
+                    next_msg_seq = 0
+                if msg_sequence == self.last_received_seq:
+                    self.log("ignoring message, sequence number is the same as last message: expected=" + str(
+                        next_msg_seq) + " actual=" + str(msg_sequence))
+                    return None, None
+                if msg_sequence != next_msg_seq:
+                    # process message anyway, and work out what was missed in the background
+                    self.sequence_gap(next_msg_seq, msg_sequence)
+            self.last_received_seq = msg_sequence
+            if self.message_filter is not None and not self.message_wanted(payload):
+                return None, None
+        elif msg_type == self.HEADER_TYPE_COMMAND:
+            self.log("received command unexpectedly")
+            return None
+        return msg_type, payload
+
+    def sequence_gap(self, expected, actual):
+        missed = self.sequence_gaps.record(expected, actual, time.time())
+        if missed is None:
+            self.log("message seq went backwards - processing message anyway: expected=" + str(
+                expected) + " actual=" + str(actual))
+            return
+        self.log("message seq incorrect - missed {:d} messages: expected={:d} actual={:d}".format(
+            missed, expected, actual))
+        if not self.gap_recovery_queued:
+            self.gap_recovery_queued = True
+            self.scheduler.submit(self.scheduler.BULK, self.recover_from_gap)
+
+    def recover_from_gap(self):
+        """Work out what was lost in gaps in the message sequence. Run as
+        bulk work, so it doesn't hold up the messages still arriving"""
+        self.gap_recovery_queued = False
+        self.sequence_gaps.recoveries += 1
+        # the lost messages may have made any cached answer out of date
+        for query in self.QUERY_CACHE_TTL:
+            self.query_cache.invalidate(query)
+        log_pointer, received = self.log_pointer, self.log_events_since_pointer
+        new_log_pointer = self.get_log_pointer()
+        # unless log events aren't asked for, in which case none are expected
+        log_events_wanted = self.message_filter is None or self.MSG_LOGEVENT in self.message_filter
+        if log_events_wanted:
+            written = None
+            if log_pointer is not None and new_log_pointer is not None:
+                written = new_log_pointer - log_pointer
+            if written is None or written < 0:
+                # the log is circular, and its size varies between panels, so a wrap can't be allowed for
+                self.sequence_gaps.log_events_unknown += 1
+                self.log("Log pointer unknown or wrapped round, can't tell how many log events were missed")
+            elif written > received:
+                self.sequence_gaps.log_events_missed += written - received
+                self.log("{:d} log events were written by the panel but never received".format(written - received))
+        # the power readings may have changed with the missed log events
+        self.get_system_power()
 
     def recvresponse(self):
         """Receive a response to a command. Automatically handles any
         messages that arrive first"""
         startTime = time.time()
+        profiler = self.active_profiler
         while True:
             if time.time() - startTime > self.CMD_TIMEOUT:
                 # if we have had multiple event messages, we may get to the timeout time without the recv timing out
                 raise socket.timeout
             assert self.last_command_time > 0
-            time_since_last_command = time.time() - self.last_command_time
-            if time_since_last_command > 30:
-                # send any message to reset the panel's 60 second timeout
-                # this ends up recursively calling recvresponse; however as our retry * timeout (3 * 2 == 6) is
-                # far less than the 30 seconds between idle commands that won't be an issue
-                if self.lastIdleCommand == 0:
-                    result = self.get_date_time()
-                elif self.lastIdleCommand == 1:
-                    result = self.get_log_pointer()
-                else:
-                    result = self.get_system_power()
-                self.lastIdleCommand += 1
-                if self.lastIdleCommand == 3:
-                    self.lastIdleCommand = 0
-                if result is None:
-                    self.log("idle command failed; closing socket")
-                    self.closesocket()
-                    return None
-            header = self.s.recv(self.LENGTH_HEADER)
-            if self.print_network_traffic:
-                self.log("Received message header:")
-                hexdump.hexdump(header)
-            if header == "+++":
-                self.log("Panel has forcibly dropped connection, possibly due to inactivity")
-                self.closesocket()
-                return None
-            if header == "+++A":
-                self.log("Panel is trying to hangup modem; probably connected too soon")
-                self.closesocket()
-                return None
-            if len(header) == 0:
-                self.log("Panel has closed connection")
-                self.closesocket()
-                return None
-            if len(header) < self.LENGTH_HEADER:
-                self.log("Header received from panel is too short, only {:d} bytes, ignoring - contents {}".format(
-                    len(header), self.hexstr(header)))
-                hexdump.hexdump(header)
-                continue
-            msg_start, msg_type, msg_length, msg_sequence = list(header)
-            if msg_start != 't':
-                self.log("unexpected msg start: " + hex(ord(msg_start)))
-                hexdump.hexdump(header)
-                return None
-            expected_len = ord(msg_length) - self.LENGTH_HEADER
-            payload = self.s.recv(expected_len)
-            if self.print_network_traffic:
-                self.log("Received message payload:")
-                hexdump.hexdump(payload)
-            if len(payload) < expected_len:
-                self.log(
-                    "Ignoring message, payload shorter than expected - got {:d} bytes, expected {:d} - contents {}".format(
-                        len(payload), expected_len, self.hexstr(payload)))
-                print("header:")
-                hexdump.hexdump(header)
-                print("payload:")
-                hexdump.hexdump(payload)
-                continue
-            payload, msg_crc = payload[:-1], ord(payload[-1])
-            expected_crc = self.crc8_func(header + payload)
-            if msg_crc != expected_crc:
-                self.log("crc: expected=" + str(expected_crc) + " actual=" + str(msg_crc))
+            frame = self.recvframe()
+            if frame is None:
                 return None
+            msg_type, payload = frame
             if msg_type == self.HEADER_TYPE_RESPONSE:
-                if msg_sequence != self.last_sequence:
-                    self.log(
-                        "incorrect response seq: expected=" + str(self.last_sequence) + " actual=" + str(ord(msg_sequence)))
-                    # recv again - either we receive the correct reply in the next packet, or we'll time out and retry the command
-                    continue
+                return payload
             elif msg_type == self.HEADER_TYPE_MESSAGE:
-                if self.last_received_seq != -1:
-                    next_msg_seq = self.last_received_seq + 1
-                    if next_msg_seq == 256:
-                        next_msg_seq = 0
-                    if msg_sequence == chr(self.last_received_seq):
-                        self.log("ignoring message, sequence number is the same as last message: expected=" + str(
-                            next_msg_seq) + " actual=" + str(ord(msg_sequence)))
-                        continue
-                    if msg_sequence != chr(next_msg_seq):
-                        self.log("message seq incorrect - processing message anyway: expected=" + str(
-                            next_msg_seq) + " actual=" + str(ord(msg_sequence)))
-                        # process message anyway; perhaps we missed one or they arrived out of order
-                self.last_received_seq = ord(msg_sequence)
-            if msg_type == self.HEADER_TYPE_COMMAND:
-                self.log("received command unexpectedly")
+                if profiler is not None:
+                    depth = profiler.start("handle_message")
+                self.handle_message(payload)
+                if profiler is not None:
+                    profiler.stop(depth)
+
+    def handle_message(self, payload):
+        """Called for every unsolicited message received from the panel"""
+        # FIXME: for "Site Data Changed" we should re-read the zone names etc - need to decode message
+        # self.siteDataChanged = True
+        msg_type = payload[0]
+        if msg_type in (self.MSG_AREAEVENT, self.MSG_USEREVENT, self.MSG_LOGEVENT):
+            self.query_cache.invalidate("get_lcd_display")
+        if msg_type == self.MSG_LOGEVENT and len(payload) > 1:
+            self.log_events_since_pointer += 1
+            self.query_cache.invalidate("get_log_pointer")
+            query = self.LOG_EVENT_INVALIDATES.get(payload[1])
+            if query is not None:
+                self.query_cache.invalidate(query)
+        if msg_type == self.MSG_ZONEEVENT:
+            zone_event = self.parse_zone_event(payload)
+            if zone_event is not None:
+                zone_type = getattr(self.zone.get(zone_event[0]), "zoneType", None)
+                if not self.debouncer.event(zone_event[0], zone_type, zone_event[1], payload, time.time()):
+                    return
+        elif msg_type == self.MSG_OUTPUTEVENT and len(payload) > 2:
+            # output events often repeat the state the outputs are already in
+            if not self.outputs.update(payload[1], payload[2]):
+                return
+        self.dispatch_message(payload)
+
+    def dispatch_message(self, payload):
+        """Pass a message on to the area index, sinks and handlers, once any
+        debouncing is done"""
+        msg_type = payload[0]
+        self.checkpoint_dirty = True
+        if msg_type == self.MSG_ZONEEVENT:
+            zone_event = self.parse_zone_event(payload)
+            if zone_event is not None:
+                self.area_index.update_zone(*zone_event)
+                if self.state_export is not None:
+                    self.state_export.zone(*zone_event)
+        elif msg_type == self.MSG_AREAEVENT and len(payload) > 2:
+            self.area_index.update_area(payload[1], payload[2])
+            if self.state_export is not None:
+                self.state_export.area(payload[1], payload[2])
+        profiler = self.active_profiler
+        if self.sinks is not None:
+            if profiler is not None:
+                depth = profiler.start("sinks")
+            from texecomSinks import make_event
+            self.sinks.dispatch(make_event(self, payload))
+            if profiler is not None:
+                profiler.stop(depth)
+        if self.message_handler_func is not None:
+            if profiler is not None:
+                depth = profiler.start("handler")
+            self.message_handler_func(payload)
+            if profiler is not None:
+                profiler.stop(depth)
+        subscribers = self.subscribers.get(msg_type)
+        if subscribers:
+            if profiler is not None:
+                depth = profiler.start("subscribers")
+            number = self.message_number(payload)
+            for func, numbers in subscribers:
+                if numbers is None or number is None or number in numbers:
+                    func(payload)
+            if profiler is not None:
+                profiler.stop(depth)
+
+    @staticmethod
+    def parse_zone_event(payload):
+        """Return (zone number, zone bitmap) from a zone event message, or
+        None if it's the wrong length"""
+        if len(payload) == 3:
+            return payload[1], payload[2]
+        if len(payload) == 4:
+            # zone number is two bytes on 640 panels
+            return payload[1] + (payload[2] << 8), payload[3]
+        return None
+
+    def cached_query(self, query, max_age=None):
+        """Answer one of the QUERY_CACHE_TTL queries, e.g. "get_lcd_display",
+        from the cache if the last answer is recent enough, otherwise from
+        the panel. May be called from any thread; other threads' queries are
+        sent by the thread talking to the panel, and any of them asking for
+        the same query at once share the one answer"""
+        if self.panel_thread is None or threading.current_thread() is self.panel_thread:
+            # this thread runs the scheduler, so it mustn't wait for a query another thread has queued there
+            return self.query_cache.get(query, getattr(self, query), max_age, share=False)
+
+        def fetch():
+            if self.s is None:
+                # nothing queued now will be run until there's a new session
                 return None
+            return self.scheduler.submit(self.scheduler.INTERACTIVE, getattr(self, query)).wait(self.QUERY_WAIT)
+        return self.query_cache.get(query, fetch, max_age)
+
+    def poll(self, max_messages=None):
+        """Handle any frames already waiting on the socket, without blocking
+        for new ones. At most max_messages messages are handled per call so
+        that a caller driving several panels can share its time fairly.
+        Returns the number of messages handled"""
+        handled = 0
+        while self.s is not None:
+            if max_messages is not None and handled >= max_messages:
+                break
+            readable, _, _ = select.select([self.s], [], [], 0)
+            if not readable:
+                break
+            frame = self.recvframe()
+            if frame is None:
+                break
+            msg_type, payload = frame
+            if msg_type == self.HEADER_TYPE_MESSAGE:
+                profiler = self.active_profiler
+                if profiler is not None:
+                    depth = profiler.start("handle_message")
+                self.handle_message(payload)
+                if profiler is not None:
+                    profiler.stop(depth)
+                handled += 1
             elif msg_type == self.HEADER_TYPE_RESPONSE:
-                return payload
-            elif msg_type == self.HEADER_TYPE_MESSAGE:
-                # FIXME: for "Site Data Changed" we should re-read the zone names etc - need to decode message
-                # self.siteDataChanged = True
-                self.message_handler_func(payload)
-
-    def sendcommandbody(self, body):
-        self.last_sequence = chr(self.getnextseq())
-        data = self.HEADER_START + self.HEADER_TYPE_COMMAND + \
-               chr(len(body) + 5) + self.last_sequence + body
-        data += chr(self.crc8_func(data))
-        if self.print_network_traffic:
-            self.log("Sending command:")
-            hexdump.hexdump(data)
+                self.log("ignoring response received with no command outstanding")
+        return handled
+
+    def fileno(self):
+        """Allows a connected TexecomConnect to be passed to select()"""
+        return self.s.fileno()
+
+    def sendcommandbody(self, cmd, body):
+        """Assemble the frame in send_buffer, and send it"""
+        self.last_sequence = self.getnextseq()
+        length = self.COMMAND_HEADER.size + len(body) + 1
+        buf = self.send_buffer
+        self.COMMAND_HEADER.pack_into(buf, 0, self.HEADER_START, self.HEADER_TYPE_COMMAND, length,
+                                      self.last_sequence, cmd)
+        buf[self.COMMAND_HEADER.size:length - 1] = body
+        buf[length - 1] = self.crc8_func(memoryview(buf)[:length - 1])
+        # kept for resending, so it's copied out of the buffer the next command will be assembled in
+        data = bytes(buf[:length])
+        self.trace.record(self.trace.SENT, data)
         self.s.send(data)
         self.last_command = data
 
     def login(self):
-        response = self.sendcommand(self.CMD_LOGIN, self.udlpassword)
+        response = self.sendcommand(self.CMD_LOGIN, self.udlpassword.encode("ascii"))
         if response is None:
             self.log("sendcommand returned None for login")
             return False
@@ -508,25 +1476,71 @@ class TexecomConnect(object):
             self.log("NAK response from panel")
             return False
         elif response != self.CMD_RESPONSE_ACK:
-            self.log("unexpected ack payload: " + hex(ord(response)))
+            self.log("unexpected ack payload: " + self.hexstr(response))
             return False
         return True
 
+    def subscribe(self, msg_type, func, numbers=None):
+        """Call func(payload) for each message of msg_type (one of the MSG_
+        constants). For zone and area events, numbers limits it to those
+        zone/area numbers.
+
+        If there's no message_handler_func and no sinks, only the types of
+        message something has subscribed to are asked for from the panel,
+        and unwanted zone/area events are dropped as soon as they've been
+        received. Takes effect from the next login."""
+        self.subscribers.setdefault(msg_type, []).append((func, frozenset(numbers) if numbers is not None else None))
+
+    def build_message_filter(self):
+        if self.message_handler_func is not None or self.sinks is not None:
+            return None
+        message_filter = {}
+        for msg_type, subscribers in self.subscribers.items():
+            numbers = set()
+            for func, wanted in subscribers:
+                if wanted is None:
+                    numbers = None
+                    break
+                numbers |= wanted
+            message_filter[msg_type] = numbers
+        return message_filter
+
+    def message_wanted(self, payload):
+        msg_type = payload[0]
+        if msg_type not in self.message_filter:
+            return False
+        numbers = self.message_filter[msg_type]
+        if numbers is None:
+            return True
+        number = self.message_number(payload)
+        return number is None or number in numbers
+
+    def message_number(self, payload):
+        """The zone or area number of a zone or area event, otherwise None"""
+        msg_type = payload[0]
+        if msg_type == self.MSG_ZONEEVENT:
+            zone_event = self.parse_zone_event(payload)
+            return zone_event[0] if zone_event is not None else None
+        if msg_type == self.MSG_AREAEVENT and len(payload) > 1:
+            return payload[1]
+        return None
+
     def set_event_messages(self):
-        DEBUG_FLAG = 1
-        ZONE_EVENT_FLAG = 1 << 1
-        AREA_EVENT_FLAG = 1 << 2
-        OUTPUT_EVENT_FLAG = 1 << 3
-        USER_EVENT_FLAG = 1 << 4
-        LOG_FLAG = 1 << 5
-        events = ZONE_EVENT_FLAG | AREA_EVENT_FLAG | OUTPUT_EVENT_FLAG | USER_EVENT_FLAG | LOG_FLAG
-        body = chr(events & 0xff) + chr(events >> 8)
+        self.message_filter = self.build_message_filter()
+        if self.message_filter is None:
+            msg_types = self.ALL_EVENTS
+        else:
+            msg_types = self.message_filter.keys()
+        events = 0
+        for msg_type in msg_types:
+            events |= self.EVENT_FLAGS[msg_type]
+        body = struct.pack("<H", events)
         response = self.sendcommand(self.CMD_SETEVENTMESSAGES, body)
         if response == self.CMD_RESPONSE_NAK:
             self.log("NAK response from panel")
             return False
         elif response != self.CMD_RESPONSE_ACK:
-            self.log("unexpected ack payload: " + hex(ord(response)))
+            self.log("unexpected ack payload: " + self.hexstr(response))
             return False
         return True
 
@@ -536,11 +1550,13 @@ class TexecomConnect(object):
         print(timestamp + ": " + string)
 
     def sendcommand(self, cmd, body):
-        if body is not None:
-            body = cmd + body
-        else:
-            body = cmd
-        self.sendcommandbody(body)
+        profiler = self.active_profiler
+        if profiler is not None:
+            depth = profiler.start("sendcommand")
+            send_depth = profiler.start("send")
+        self.sendcommandbody(cmd, body if body is not None else b"")
+        if profiler is not None:
+            profiler.stop(send_depth)
         self.last_command_time = time.time()
         retries = self.CMD_RETRIES
         response = None
@@ -553,23 +1569,46 @@ class TexecomConnect(object):
                 self.log("Timeout waiting for response, resending last command")
                 # NB: sequence number will be the same as last attempt
                 self.last_command_time = time.time()
+                self.trace.record(self.trace.SENT, self.last_command)
                 self.s.send(self.last_command)
 
+        if profiler is not None:
+            profiler.stop(depth)
         self.last_command = None
         if response is None:
             return None
 
         commandid, payload = response[0], response[1:]
         if commandid != cmd:
-            if commandid == self.CMD_LOGIN and payload[0] == self.CMD_RESPONSE_NAK:
+            if commandid == self.CMD_LOGIN and payload[0:1] == self.CMD_RESPONSE_NAK:
                 self.log("Received 'Log on NAK' from panel - session has timed out and needs to be restarted")
                 return None
-            self.log("Got response for wrong command id: Expected " + hex(ord(cmd)) + ", got " + hex(ord(commandid)))
+            self.log("Got response for wrong command id: Expected " + hex(cmd) + ", got " + hex(commandid))
             self.log("Payload: " + self.hexstr(payload))
             return None
         return payload
 
+    def decode_response(self, name, cmd, details):
+        """Unpack a response using the layout in RESPONSE_LAYOUTS for its
+        length. details may be any buffer, including a memoryview, and isn't
+        copied. Returns the tuple of fields, or None if no layout fits"""
+        layout = self.RESPONSE_LAYOUTS[cmd].get(len(details))
+        if layout is None:
+            self.log("{}: response wrong length {:d}".format(name, len(details)))
+            self.log("Payload: " + self.hexstr(details))
+            return None
+        return layout.unpack_from(details)
+
+    @staticmethod
+    def decode_text(data):
+        return str(data, PANEL_ENCODING)
+
+    @classmethod
+    def clean_text(cls, data):
+        return NON_WORD.sub(' ', cls.decode_text(data).replace("\x00", " ")).strip()
+
     def get_date_time(self):
+        generation = self.query_cache.generation("get_date_time")
         datetimeresp = self.sendcommand(self.CMD_GETDATETIME, None)
         if datetimeresp is None:
             return None
@@ -577,7 +1616,6 @@ class TexecomConnect(object):
             self.log("GETDATETIME: response too short")
             self.log("Payload: " + self.hexstr(datetimeresp))
             return None
-        datetimeresp = bytearray(datetimeresp)
         datetimestr = '20{2:02d}-{1:02d}-{0:02d} {3:02d}:{4:02d}:{5:02d}'.format(*datetimeresp)
         paneltime = datetime.datetime(2000 + datetimeresp[2], datetimeresp[1], datetimeresp[0], *datetimeresp[3:])
         seconds = int((paneltime - datetime.datetime.now()).total_seconds())
@@ -586,9 +1624,11 @@ class TexecomConnect(object):
         else:
             diff = " (panel is behind by {:d} seconds)".format(-seconds)
         self.log("Panel date/time: " + datetimestr + diff)
+        self.query_cache.put("get_date_time", datetimestr, generation)
         return datetimestr
 
     def get_lcd_display(self):
+        generation = self.query_cache.generation("get_lcd_display")
         lcddisplay = self.sendcommand(self.CMD_GETLCDDISPLAY, None)
         if lcddisplay is None:
             return None
@@ -596,19 +1636,24 @@ class TexecomConnect(object):
             self.log("GETLCDDISPLAY: response wrong length")
             self.log("Payload: " + self.hexstr(lcddisplay))
             return None
+        lcddisplay = self.decode_text(lcddisplay)
         self.log("Panel LCD display: " + lcddisplay)
+        self.query_cache.put("get_lcd_display", lcddisplay, generation)
         return lcddisplay
 
     def get_log_pointer(self):
+        generation = self.query_cache.generation("get_log_pointer")
         logpointerresp = self.sendcommand(self.CMD_GETLOGPOINTER, None)
         if logpointerresp is None:
             return None
-        if len(logpointerresp) != 2:
-            self.log("GETLOGPOINTER: response wrong length")
-            self.log("Payload: " + self.hexstr(logpointerresp))
+        fields = self.decode_response("GETLOGPOINTER", self.CMD_GETLOGPOINTER, logpointerresp)
+        if fields is None:
             return None
-        logpointer = ord(logpointerresp[0]) + (ord(logpointerresp[1]) << 8)
+        logpointer = fields[0]
+        self.log_pointer = logpointer
+        self.log_events_since_pointer = 0
         self.log("Log pointer: {:d}".format(logpointer))
+        self.query_cache.put("get_log_pointer", logpointer, generation)
         return logpointer
 
     def get_number_zones(self):
@@ -626,43 +1671,31 @@ class TexecomConnect(object):
             self.log("GETPANELIDENTIFICATION: response wrong length")
             self.log("Payload: " + self.hexstr(panelid))
             return None
+        panelid = self.decode_text(panelid)
         self.log("Panel identification: " + panelid)
         return panelid
 
     def get_zone(self, zone_number):
         if zone_number not in self.zone:
             self.zone[zone_number] = Zone(zone_number)
+            self.decode_cache.clear()
         return self.zone[zone_number]
 
     def get_zone_details(self, zone_number):
         # zone is two bytes on 680
-        details = self.sendcommand(self.CMD_GETZONEDETAILS, chr(zone_number))
+        details = self.sendcommand(self.CMD_GETZONEDETAILS, bytes((zone_number,)))
         if details is None:
             return None
-        zone = self.get_zone(zone_number)
-        if len(details) == 34:
-            zone.zoneType = ord(details[0])
-            zone.areaBitmap = ord(details[1])
-            zone.text = details[2:]
-        elif len(details) == 35:
-            zone.zoneType = ord(details[0])
-            zone.areaBitmap = ord(details[1]) + (ord(details[2]) << 8)
-            zone.text = details[3:]
-        elif len(details) == 41:
-            zone.zoneType = ord(details[0])
-            zone.areaBitmap = ord(details[1]) + (ord(details[2]) << 8) + (ord(details[3]) << 16) + (
-                        ord(details[4]) << 24) + \
-                              (ord(details[5]) << 32) + (ord(details[6]) << 40) + (ord(details[7]) << 48) + (
-                                          ord(details[8]) << 56)
-            zone.text = details[9:]
-        else:
-            self.log("GETZONEDETAILS: response wrong length")
-            self.log("Payload: " + self.hexstr(details))
+        fields = self.decode_response("GETZONEDETAILS", self.CMD_GETZONEDETAILS, details)
+        if fields is None:
             return None
-
-        zone.text = zone.text.replace("\x00", " ")
-        zone.text = re.sub(r'\W+', ' ', zone.text)
-        zone.text = zone.text.strip()
+        zone = self.get_zone(zone_number)
+        zone.zoneType, zone.areaBitmap, text = fields
+        zone.text = self.clean_text(text)
+        self.decode_cache.clear()
+        self.area_index.set_zone_areas(zone.number, zone.areaBitmap if zone.zoneType != self.ZONETYPE_UNUSED else 0)
+        if self.state_export is not None:
+            self.state_export.zone_type(zone.number, zone.zoneType)
         if zone.zoneType != self.ZONETYPE_UNUSED:
             self.log("zone {:d} type {} name '{}'".
                      format(zone.number, self.zone_types[zone.zoneType], zone.text))
@@ -674,64 +1707,44 @@ class TexecomConnect(object):
         return self.area[areaNumber]
 
     def get_area_details(self, areaNumber):
-        details = self.sendcommand(self.CMD_GETAREADETAILS, chr(areaNumber))
+        details = self.sendcommand(self.CMD_GETAREADETAILS, bytes((areaNumber,)))
         if details is None:
             return None
-        area = Area()
-        if len(details) == 25:
-            # first byte is area number
-            areatext = details[1:17]
-            areatext = areatext.replace("\x00", " ")
-            areatext = re.sub(r'\W+', ' ', areatext)
-            areatext = areatext.strip()
-            area.name = areatext
-            area.exitDelay = ord(details[17]) + (ord(details[18]) << 8)
-            area.entry1Delay = ord(details[19]) + (ord(details[20]) << 8)
-            area.entry2Delay = ord(details[21]) + (ord(details[22]) << 8)
-            area.secondEntry = ord(details[23]) + (ord(details[24]) << 8)
-        else:
-            self.log("GETAREADETAILS: response wrong length")
-            self.log("Payload: " + self.hexstr(details))
+        fields = self.decode_response("GETAREADETAILS", self.CMD_GETAREADETAILS, details)
+        if fields is None:
             return None
+        area = Area()
+        _, areatext, area.exitDelay, area.entry1Delay, area.entry2Delay, area.secondEntry = fields
+        area.name = self.clean_text(areatext)
         self.log("area {:d} text '{}' exitDelay {:d} entry1 {:d} entry2 {:d} secondEntry {:d}".
-                 format(areaNumber, area.name, area.exitDelay, area.entry1Delay, area.entry1Delay, area.secondEntry))
+                 format(areaNumber, area.name, area.exitDelay, area.entry1Delay, area.entry2Delay, area.secondEntry))
         return area
 
     @staticmethod
     def bcdDecode(bcd):
         result = ""
-        for char in bcd:
-            for val in (ord(char) >> 4, ord(char) & 0xF):
+        for byte in bcd:
+            for val in (byte >> 4, byte & 0xF):
                 if val <= 9:
                     result += str(val)
         return result
 
     def get_user(self, usernumber):
         # panel may support more than 255 users, in which case this needs 2 bytes
-        # body = chr(usernumber & 0xff)+chr(usernumber >> 8)
-        body = chr(usernumber)
+        # body = struct.pack("<H", usernumber)
+        body = bytes((usernumber,))
         details = self.sendcommand(self.CMD_GETUSER, body)
         if details is None:
             return None
-        user = User()
-        if len(details) == 23:
-            username = details[0:8]
-            username = username.replace("\x00", " ")
-            username = re.sub(r'\W+', ' ', username)
-            username = username.strip()
-            user.name = username
-            user.passcode = self.bcdDecode(details[8:11])
-            user.areas = ord(details[11])
-            user.modifiers = details[12]
-            user.locks = details[13]
-            user.doors = details[14:17]
-            user.tag = self.bcdDecode(details[17:21])  # last byte always 0xff
-            user.config = ord(details[21]) + (ord(details[22]) << 8)
-        else:
-            # there are other lengths but I have no way to test
-            self.log("GETUSER: unexpected response length {:d}".format(len(details)))
-            self.log("Payload: " + self.hexstr(details))
+        # there are other lengths but I have no way to test
+        fields = self.decode_response("GETUSER", self.CMD_GETUSER, details)
+        if fields is None:
             return None
+        user = User()
+        username, passcode, user.areas, user.modifiers, user.locks, user.doors, tag, user.config = fields
+        user.name = self.clean_text(username)
+        user.passcode = self.bcdDecode(passcode)
+        user.tag = self.bcdDecode(tag)  # last byte always 0xff
 
         if user.valid():
             self.log("user {:d} name '{}'".
@@ -739,18 +1752,14 @@ class TexecomConnect(object):
         return user
 
     def get_system_power(self):
+        generation = self.query_cache.generation("get_system_power")
         details = self.sendcommand(self.CMD_GETSYSTEMPOWER, None)
         if details is None:
             return None
-        if len(details) != 5:
-            self.log("GETSYSTEMPOWER: response wrong length")
-            self.log("Payload: " + self.hexstr(details))
+        fields = self.decode_response("GETSYSTEMPOWER", self.CMD_GETSYSTEMPOWER, details)
+        if fields is None:
             return None
-        ref_v = ord(details[0])
-        sys_v = ord(details[1])
-        bat_v = ord(details[2])
-        sys_i = ord(details[3])
-        bat_i = ord(details[4])
+        ref_v, sys_v, bat_v, sys_i, bat_i = fields
 
         system_voltage = 13.7 + ((sys_v - ref_v) * 0.070)
         battery_voltage = 13.7 + ((bat_v - ref_v) * 0.070)
@@ -760,34 +1769,169 @@ class TexecomConnect(object):
 
         self.log("System power: system voltage {:f} battery voltage {:f} system current {:d} battery current {:d}".
                  format(system_voltage, battery_voltage, system_current, battery_current))
-        return (system_voltage, battery_voltage, system_current, battery_current)
+        power = (system_voltage, battery_voltage, system_current, battery_current)
+        self.query_cache.put("get_system_power", power, generation)
+        if self.state_export is not None:
+            self.state_export.power(power)
+        return power
+
+    def read_zone(self, zoneNumber):
+        zone = self.get_zone_details(zoneNumber)
+        if zone is not None:
+            self.zone[zoneNumber] = zone
+
+    def read_user(self, usernumber):
+        user = self.get_user(usernumber)
+        if user is not None and user.valid():
+            self.user[usernumber] = user
+            self.decode_cache.clear()
+
+    def read_area(self, areanumber):
+        area = self.get_area_details(areanumber)
+        self.area[areanumber] = area
+        self.decode_cache.clear()
 
     def get_all_zones(self):
         for zoneNumber in range(1, self.numberOfZones + 1):
-            zone = self.get_zone_details(zoneNumber)
-            self.zone[zoneNumber] = zone
+            self.read_zone(zoneNumber)
 
     def get_all_users(self):
-        panel_users = {12: 8, 24: 25, 48: 50, 64: 50, 88: 100, 168: 200, 640: 1000}
-        for usernumber in range(1, panel_users[self.numberOfZones]):
-            user = self.get_user(usernumber)
-            if user.valid():
-                self.user[usernumber] = user
+        for usernumber in range(1, self.PANEL_USERS[self.numberOfZones]):
+            self.read_user(usernumber)
         user = User()
         user.name = "Engineer"
         self.user[0] = user
+        self.decode_cache.clear()
 
     def get_all_areas(self):
-        panel_areas = {12: 2, 24: 2, 48: 4, 64: 4, 88: 8, 168: 16, 640: 64}
-        for areanumber in range(1, panel_areas[self.numberOfZones]):
-            area = self.get_area_details(areanumber)
-            self.area[areanumber] = area
+        for areanumber in range(1, self.PANEL_AREAS[self.numberOfZones]):
+            self.read_area(areanumber)
 
     def get_site_data(self):
         self.get_all_areas()
         self.get_all_zones()
         self.get_all_users()
 
+    def queue_site_data(self):
+        """Read the same data as get_site_data, but as bulk work on the
+        scheduler so that more urgent commands don't have to wait for it"""
+        bulk = self.scheduler.BULK
+        for areanumber in range(1, self.PANEL_AREAS[self.numberOfZones]):
+            self.scheduler.submit(bulk, self.read_area, areanumber)
+        for zoneNumber in range(1, self.numberOfZones + 1):
+            self.scheduler.submit(bulk, self.read_zone, zoneNumber)
+        for usernumber in range(1, self.PANEL_USERS[self.numberOfZones]):
+            self.scheduler.submit(bulk, self.read_user, usernumber)
+        user = User()
+        user.name = "Engineer"
+        self.user[0] = user
+        self.decode_cache.clear()
+        self.scheduler.submit(bulk, self.site_data_loaded)
+
+    def site_data_loaded(self):
+        self.log("Got all areas/zones/users")
+        self.checkpoint_dirty = True
+
+    def start_session(self):
+        """Connect, log in and subscribe to events. Returns False (with the
+        socket closed) if any step fails. The thread calling this is the one
+        that talks to the panel from then on"""
+        self.panel_thread = threading.current_thread()
+        # the panel carries on numbering its messages whilst we're not connected, so don't expect any in particular
+        self.last_received_seq = -1
+        try:
+            self.connect()
+        except socket.error as e:
+            self.log("Connect failed - {}".format(e))
+            self.closesocket()
+            return False
+        if not self.login():
+            self.log(
+                "Login failed - udl password incorrect, pre-v4 panel, or trying to connect too soon: closing socket")
+            self.closesocket()
+            return False
+        self.log("login successful")
+        if not self.set_event_messages():
+            self.log("Set event messages failed, closing socket")
+            self.closesocket()
+            return False
+        if self.state_export is not None:
+            self.state_export.link(True)
+        return True
+
+    def load_panel_data(self):
+        self.get_number_zones()
+        self.get_date_time()
+        self.get_system_power()
+        self.get_log_pointer()
+        if self.restored_panel is not None:
+            restored_panel, self.restored_panel = self.restored_panel, None
+            if restored_panel == (self.panelType, self.numberOfZones):
+                # warm restart: carry on with the checkpointed site data, and refresh it once things have settled
+                self.site_data_refresh_at = time.time() + self.WARM_RESTART_REFRESH_DELAY
+                return
+            self.log("Panel is not the one in the checkpoint; discarding checkpointed site data")
+            self.zone.clear()
+            self.area.clear()
+            self.user.clear()
+            self.decode_cache.clear()
+            self.area_index = AreaIndex()
+        self.queue_site_data()
+
+    def service(self):
+        """Housekeeping to run regularly whilst connected: zone timers, site
+        data reloads and keeping the panel session alive"""
+        profiler = self.active_profiler
+        for payload in self.debouncer.due(time.time()):
+            self.dispatch_message(payload)
+        if profiler is not None:
+            depth = profiler.start("zone_update")
+        for zone in self.zone.values():
+            zone.update()
+        if profiler is not None:
+            profiler.stop(depth)
+        if self.capture is not None:
+            self.capture.flush_if_due(time.time())
+        if self.site_data_refresh_at is not None and time.time() >= self.site_data_refresh_at:
+            self.site_data_refresh_at = None
+            self.siteDataChanged = True
+        if self.siteDataChanged:
+            self.siteDataChanged = False
+            self.queue_site_data()
+        if self.checkpoint_file is not None and self.checkpoint_dirty and \
+                time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            if profiler is not None:
+                depth = profiler.start("checkpoint")
+            self.save_checkpoint()
+            if profiler is not None:
+                profiler.stop(depth)
+        if self.s is not None and time.time() - self.last_command_time > 30:
+            # send any message to reset the panel's 60 second timeout
+            if not self.scheduler.pending_priority(self.scheduler.KEEPALIVE):
+                self.scheduler.submit(self.scheduler.KEEPALIVE, self.keepalive)
+
+    def wait_timeout(self, timeout):
+        """How long to wait for the panel before service() and the scheduler
+        next need to run, up to timeout"""
+        if self.scheduler.pending():
+            return 0
+        due = self.debouncer.next_due()
+        if due is not None:
+            timeout = max(0, min(timeout, due - time.time()))
+        return timeout
+
+    def run_stage(self, stage, func):
+        """Run one of the event loop's stages, as a stage of the profile if
+        profiling is on"""
+        profiler = self.active_profiler
+        if profiler is None:
+            return func()
+        depth = profiler.start(stage)
+        try:
+            return func()
+        finally:
+            profiler.stop(depth)
+
     def event_loop(self):
         lastConnectedAt = time.time()
         notifiedConnectionLoss = False
@@ -800,60 +1944,94 @@ class TexecomConnect(object):
                 self.log("Connection lost")
             connectionLostTime = time.time() - lastConnectedAt
             if connectionLostTime >= 60 and not notifiedConnectionLoss:
-                self.log("Connection lost for over 60 seconds - calling send-message.sh")
-                os.system("./send-message.sh 'connection lost'")
+                self.log("Connection lost for over 60 seconds - sending notification")
+                self.notify("connection lost")
                 notifiedConnectionLoss = True
-            try:
-                self.connect()
-            except socket.error as e:
-                self.log("Connect failed - {}; sleeping for 5 seconds".format(e))
+            if not self.start_session():
+                self.log("Trying again in 5 seconds")
                 time.sleep(5)
                 continue
-            if not self.login():
-                self.log(
-                    "Login failed - udl password incorrect, pre-v4 panel, or trying to connect too soon: closing socket, try again 5 in seconds")
-                time.sleep(5)
-                self.closesocket()
-                continue
-            self.log("login successful")
-            if not self.set_event_messages():
-                self.log("Set event messages failed, closing socket")
-                self.closesocket()
-                continue
             connected = True
             if notifiedConnectionLoss:
-                self.log("Connection regained - calling send-message.sh")
-                os.system("./send-message.sh 'connection regained'")
-            self.get_number_zones()
-            self.get_date_time()
-            self.get_system_power()
-            self.get_log_pointer()
-            self.get_site_data()
-            self.log("Got all areas/zones/users; waiting for events")
+                self.log("Connection regained - sending notification")
+                self.notify("connection regained")
+            self.load_panel_data()
+            self.log("Waiting for events")
             while self.s is not None:
                 try:
-                    for zone in self.zone.values():
-                        zone.update()
-                    if self.siteDataChanged:
-                        self.siteDataChanged = False
-                        self.get_site_data()
-                    self.recvresponse()
+                    self.run_stage("service", self.service)
+                    self.run_stage("scheduler", self.scheduler.run)
+                    if self.s is None:
+                        break
+                    timeout = self.wait_timeout(self.CMD_TIMEOUT)
+                    readable, _, _ = select.select([self.s, self.scheduler], [], [], timeout)
+                    if self.s in readable:
+                        self.run_stage("poll", self.poll)
 
                 except socket.timeout:
-                    # we didn't send any command, so a timeout is the expected result, continue our loop
+                    # a frame arrived only partially, continue our loop
                     continue
 
     def decode_message_to_text(self, payload):
+        """Describe a message from the panel. Most messages are repeats of
+        the last few (a zone going active and back again) so the text is
+        looked up in decode_cache, apart from log events, which carry a
+        timestamp so rarely repeat"""
+        if payload[0] == self.MSG_LOGEVENT:
+            self.decode_cache.bypassed += 1
+            return self.decode_message_uncached(payload)
+        key = bytes(payload)
+        text = self.decode_cache.get(key)
+        if text is None:
+            text = self.decode_message_uncached(payload)
+            self.decode_cache.put(key, text)
+        return text
+
+    def decode_message_uncached(self, payload):
+        profiler = self.active_profiler
+        if profiler is None:
+            return self.decode_message(payload)
+        depth = profiler.start("decode")
+        text = self.decode_message(payload)
+        profiler.stop(depth)
+        return text
+
+    output_locations = ["Panel outputs",
+                        "Digi outputs",
+                        "Digi Channel low 8",
+                        "Digi Channel high 8",
+                        "Redcare outputs",
+                        "Custom outputs 1",
+                        "Custom outputs 2",
+                        "Custom outputs 3",
+                        "Custom outputs 4",
+                        "X-10 outputs"]
+
+    area_states = ["disarmed", "in exit", "in entry", "armed", "part armed", "in alarm"]
+
+    def area_state_name(self, area_state):
+        if area_state is None or area_state >= len(self.area_states):
+            return "unknown"
+        return self.area_states[area_state]
+
+    def output_location_name(self, output_location):
+        if output_location < len(self.output_locations):
+            return self.output_locations[output_location]
+        elif (output_location & 0xf) == 0:
+            return "Network {:d} keypad outputs".format(output_location >> 4)
+        return "Network {:d} expander {:d} outputs".format(output_location >> 4, output_location & 0xf)
+
+    def decode_message(self, payload):
         msg_type, payload = payload[0], payload[1:]
         if msg_type == self.MSG_DEBUG:
             return "Debug message: " + self.hexstr(payload)
         elif msg_type == self.MSG_ZONEEVENT:
             if len(payload) == 2:
-                zone_number = ord(payload[0])
-                zone_bitmap = ord(payload[1])
+                zone_number = payload[0]
+                zone_bitmap = payload[1]
             elif len(payload) == 3:
-                zone_number = ord(payload[0]) + (ord(payload[1]) << 8)
-                zone_bitmap = ord(payload[2])
+                zone_number = payload[0] + (payload[1] << 8)
+                zone_bitmap = payload[2]
             else:
                 return "unknown zone event message payload length"
             zone_state = zone_bitmap & 0x3
@@ -877,40 +2055,23 @@ class TexecomConnect(object):
             return "Zone event message: zone {:d} '{}' {}". \
                 format(zone_number, zone_text, zone_str)
         elif msg_type == self.MSG_AREAEVENT:
-            area_number = ord(payload[0])
-            area_state = ord(payload[1])
-            area_state_str = ["disarmed", "in exit", "in entry", "armed", "part armed", "in alarm"][area_state]
+            area_number = payload[0]
+            area_state = payload[1]
+            area_state_str = self.area_state_name(area_state)
             if area_number in self.area:
                 areaname = self.area[area_number].name
             else:
                 areaname = "unknown"
             return "Area event message: area {:d} {} {}".format(area_number, areaname, area_state_str)
         elif msg_type == self.MSG_OUTPUTEVENT:
-            locations = ["Panel outputs",
-                         "Digi outputs",
-                         "Digi Channel low 8",
-                         "Digi Channel high 8",
-                         "Redcare outputs",
-                         "Custom outputs 1",
-                         "Custom outputs 2",
-                         "Custom outputs 3",
-                         "Custom outputs 4",
-                         "X-10 outputs"]
-            output_location = ord(payload[0])
-            output_state = ord(payload[1])
-            if output_location < len(locations):
-                output_name = locations[output_location]
-            elif (output_location & 0xf) == 0:
-                output_name = "Network {:d} keypad outputs". \
-                    format(output_location >> 4, output_location & 0xf)
-            else:
-                output_name = "Network {:d} expander {:d} outputs". \
-                    format(output_location >> 4, output_location & 0xf)
+            output_location = payload[0]
+            output_state = payload[1]
+            output_name = self.output_location_name(output_location)
             return "Output event message: location {:d}['{}'] now 0x{:02x}". \
                 format(output_location, output_name, output_state)
         elif msg_type == self.MSG_USEREVENT:
-            user_number = ord(payload[0])
-            user_state = ord(payload[1])
+            user_number = payload[0]
+            user_state = payload[1]
             user_state_str = ["code", "tag", "code+tag"][user_state]
             if user_number in self.user:
                 name = self.user[user_number].name
@@ -920,27 +2081,26 @@ class TexecomConnect(object):
                 format(name, user_number, user_state_str)
         elif msg_type == self.MSG_LOGEVENT:
             if len(payload) == 8:
-                parameter = ord(payload[2])
-                areas = ord(payload[3])
+                parameter = payload[2]
+                areas = payload[3]
                 timestamp = payload[4:8]
             elif len(payload) == 9:
                 # Premier 168 - longer message as 16 bits of area info
-                parameter = ord(payload[2])
-                areas = ord(payload[3]) + (ord(payload[8]) << 8)
+                parameter = payload[2]
+                areas = payload[3] + (payload[8] << 8)
                 timestamp = payload[4:8]
             elif len(payload) == 10:
                 # Premier 640
                 # I'm unsure if this is correct and I don't have a panel to test with
-                parameter = ord(payload[2]) + (ord(payload[3]) << 8)
-                areas = ord(payload[4]) + (ord(payload[5]) << 8)
+                parameter = payload[2] + (payload[3] << 8)
+                areas = payload[4] + (payload[5] << 8)
                 timestamp = payload[6:10]
             else:
                 return "unknown log event message payload length"
 
-            event_type = ord(payload[0])
-            group_type_msg = ord(payload[1])
-            timestamp_int = ord(timestamp[0]) + (ord(timestamp[1]) << 8) + (ord(timestamp[2]) << 16) + (
-                        ord(timestamp[3]) << 24)
+            event_type = payload[0]
+            group_type_msg = payload[1]
+            timestamp_int = timestamp[0] + (timestamp[1] << 8) + (timestamp[2] << 16) + (timestamp[3] << 24)
             seconds = timestamp_int & 63
             minutes = (timestamp_int >> 6) & 63
             month = (timestamp_int >> 12) & 15
@@ -973,14 +2133,13 @@ class TexecomConnect(object):
                                                                                         group_type_str, parameter,
                                                                                         areas)
         else:
-            return "unknown message type " + str(ord(msg_type)) + ": " + self.hexstr(payload)
+            return "unknown message type " + str(msg_type) + ": " + self.hexstr(payload)
 
 def message_handler(payload):
     tc.log(tc.decode_message_to_text(payload))
-    msg_type, payload = payload[0], payload[1:]
-    if msg_type == tc.MSG_ZONEEVENT:
-        zone_number = ord(payload[0])
-        zone_bitmap = ord(payload[1])
+    zone_event = tc.parse_zone_event(payload) if payload[0] == tc.MSG_ZONEEVENT else None
+    if zone_event is not None:
+        zone_number, zone_bitmap = zone_event
         zone = tc.get_zone(zone_number)
         zone.state = zone_bitmap & 0x3
         if zone.state == 1:
@@ -1008,7 +2167,7 @@ class Unbuffered(object):
 
 if __name__ == '__main__':
     texhost = os.getenv('TEXHOST','192.168.1.9')
-    texport = os.getenv('TEXPORT',10001)
+    texport = int(os.getenv('TEXPORT',10001))
     # This is the default UDL password for a factory panel. For any real
     # installation, use wintex to set the UDL password in the panel to a
     # random 16 character alphanumeric string.
@@ -1016,4 +2175,17 @@ if __name__ == '__main__':
 
     sys.stdout = Unbuffered(sys.stdout)
     tc = TexecomConnect(texhost, texport, udlpassword, message_handler)
+    if os.getenv('CAPTURE_FILE'):
+        tc.start_capture(os.getenv('CAPTURE_FILE'))
+    if os.getenv('CHECKPOINT_FILE'):
+        tc.enable_checkpoints(os.getenv('CHECKPOINT_FILE'))
+    if os.getenv('STATE_FILE'):
+        tc.start_state_export(os.getenv('STATE_FILE'))
+    if os.getenv('HTTP_LISTEN'):
+        tc.start_http_server(os.getenv('HTTP_LISTEN'))
+    if os.getenv('PROFILE_FILE'):
+        tc.enable_profile_signals(os.getenv('PROFILE_FILE'))
+    from texecomSinks import sinks_from_environment
+    for sink in sinks_from_environment():
+        tc.add_sink(sink)
     tc.event_loop()
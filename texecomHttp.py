@@ -0,0 +1,283 @@
+#
+# Read-only HTTP API serving panel state from memory, with an event stream
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Everything is answered from the TexecomConnect's tables and caches, so
+# no request ever results in a command being sent to the panel:
+#
+#   GET /zones   zone names, types, states and the areas they're in
+#   GET /areas   area names, states and counts of active/tamper/bypassed zones
+#   GET /users   user names (never passcodes or tags)
+#   GET /outputs the last state of each output location
+#   GET /power   the last power readings
+#   GET /link    whether the panel is connected, what it is, and messages lost in sequence gaps
+#   GET /state   all of the above
+#   GET /events  server-sent events stream; each message from the panel as
+#                "data: {json}" in the form texecomSinks.make_event builds
+#
+# The server runs its own select() loop on a background thread. Each client
+# has its own output buffer; an event stream client that falls too far
+# behind is disconnected rather than holding anything else up.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import fcntl
+import json
+import os
+import select
+import socket
+import threading
+import time
+
+from texecomProxy import to_text
+from texecomSinks import Sink
+
+
+class HttpClient(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbuf = b""
+        self.outbuf = collections.deque()
+        self.outbytes = 0
+        self.streaming = False
+        self.close_when_sent = False
+        self.last_write = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def queue(self, data):
+        self.outbuf.append(data)
+        self.outbytes += len(data)
+        self.last_write = time.time()
+
+    def flush(self):
+        while self.outbuf:
+            data = self.outbuf[0]
+            sent = self.sock.send(data)
+            self.outbytes -= sent
+            if sent < len(data):
+                self.outbuf[0] = data[sent:]
+                return
+            self.outbuf.popleft()
+
+
+class StateServer(Sink):
+    """Serves the state of a TexecomConnect over HTTP. Add it to the
+    TexecomConnect with add_sink() so it gets the panel's messages for the
+    event stream"""
+
+    # a client with this many bytes waiting to be sent to it is too slow and is disconnected
+    MAX_CLIENT_BUFFER = 256 * 1024
+    MAX_REQUEST = 8192
+    # send a comment to event stream clients this often, so idle connections aren't timed out
+    STREAM_KEEPALIVE = 15
+    STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+    def __init__(self, tc, listen_socket):
+        super(StateServer, self).__init__("http", batch_size=100)
+        self.tc = tc
+        self.listen_socket = listen_socket
+        self.listen_socket.setblocking(False)
+        self.clients = []
+        self.events = collections.deque()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.routes = {
+            "/zones": self.zones,
+            "/areas": self.areas,
+            "/users": self.users,
+            "/outputs": self.outputs,
+            "/power": self.power,
+            "/link": self.link,
+            "/state": self.state,
+        }
+        self.server = None
+
+    def start(self, log):
+        super(StateServer, self).start(log)
+        self.server = threading.Thread(target=self.run_server)
+        self.server.daemon = True
+        self.server.start()
+
+    def write(self, events):
+        # called on the sink's worker thread; the server thread sends them out
+        self.events.extend(events)
+        try:
+            os.write(self.wakeup_write, b"x")
+        except OSError:
+            # pipe is full, so the server thread is going to wake up anyway
+            pass
+
+    def zones(self):
+        zones = []
+        bitmaps = self.tc.area_index.zone_bitmap
+        for number, zone in sorted(list(self.tc.zone.items())):
+            zone_type = getattr(zone, "zoneType", None)
+            if zone_type == self.tc.ZONETYPE_UNUSED:
+                continue
+            zones.append({
+                "number": number,
+                "name": to_text(zone.text),
+                "type": zone_type,
+                "type_name": self.tc.zone_types.get(zone_type),
+                "bitmap": bitmaps.get(number),
+                "active": zone.active,
+                "active_since": zone.active_since,
+                "last_active": zone.last_active,
+                "areas": list(self.tc.area_index.zone_areas.get(number, ())),
+            })
+        return zones
+
+    def areas(self):
+        areas = []
+        for number, area in sorted(list(self.tc.area.items())):
+            if area is None:
+                continue
+            summary = self.tc.area_index.summary(number)
+            summary.update({"number": number, "name": to_text(area.name),
+                            "state": self.tc.area_state_name(self.tc.area_index.area_state.get(number))})
+            areas.append(summary)
+        return areas
+
+    def users(self):
+        return [{"number": number, "name": to_text(getattr(user, "name", ""))}
+                for number, user in sorted(list(self.tc.user.items()))]
+
+    def outputs(self):
+        return [{"location": location, "name": self.tc.output_location_name(location), "state": state}
+                for location, state in sorted(list(self.tc.outputs.states.items()))]
+
+    def power(self):
+        cached = self.tc.query_cache.values.get("get_system_power")
+        if cached is None:
+            return None
+        when, (system_voltage, battery_voltage, system_current, battery_current) = cached
+        return {"time": when, "system_voltage": system_voltage, "battery_voltage": battery_voltage,
+                "system_current": system_current, "battery_current": battery_current}
+
+    def link(self):
+        return {
+            "connected": self.tc.s is not None,
+            "panel_type": to_text(self.tc.panelType),
+            "zones": self.tc.numberOfZones,
+            "firmware": to_text(self.tc.firmwareVersion),
+            "sequence_gaps": self.tc.sequence_gaps.summary(),
+        }
+
+    def state(self):
+        return dict((path[1:], handler()) for path, handler in self.routes.items() if path != "/state")
+
+    def respond(self, client, status, body, content_type="application/json"):
+        headers = "HTTP/1.1 {:d} {}\r\nContent-Type: {}\r\nContent-Length: {:d}\r\nConnection: close\r\n\r\n".format(
+            status, self.STATUS[status], content_type, len(body))
+        client.queue(headers.encode("ascii") + body)
+        client.close_when_sent = True
+
+    def handle_request(self, client):
+        request_line = client.inbuf.split(b"\r\n", 1)[0].decode("latin-1")
+        parts = request_line.split()
+        if len(parts) != 3:
+            self.respond(client, 400, b"bad request\n", "text/plain")
+            return
+        method, path = parts[0], parts[1].split("?", 1)[0]
+        if method != "GET":
+            self.respond(client, 405, b"only GET is supported\n", "text/plain")
+        elif path == "/events":
+            client.queue(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                         b"Connection: keep-alive\r\n\r\n")
+            client.streaming = True
+        elif path in self.routes:
+            body = json.dumps(self.routes[path](), sort_keys=True) + "\n"
+            self.respond(client, 200, body.encode("utf-8"))
+        else:
+            self.respond(client, 404, b"not found\n", "text/plain")
+
+    def drop_client(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        client.sock.close()
+
+    def accept(self):
+        try:
+            sock, address = self.listen_socket.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        self.clients.append(HttpClient(sock, address or "unix socket"))
+
+    def read_client(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error:
+            data = b""
+        if not data:
+            self.drop_client(client)
+            return
+        if client.streaming or client.close_when_sent:
+            # nothing more is expected from the client
+            return
+        client.inbuf += data
+        if b"\r\n\r\n" in client.inbuf:
+            self.handle_request(client)
+        elif len(client.inbuf) > self.MAX_REQUEST:
+            self.respond(client, 400, b"request too long\n", "text/plain")
+
+    def send_events(self):
+        try:
+            while os.read(self.wakeup_read, 512):
+                pass
+        except OSError:
+            pass
+        while self.events:
+            event = self.events.popleft()
+            data = ("data: " + json.dumps(event, sort_keys=True) + "\n\n").encode("utf-8")
+            for client in list(self.clients):
+                if client.streaming:
+                    client.queue(data)
+                    if client.outbytes > self.MAX_CLIENT_BUFFER:
+                        self.log("HTTP event stream client {} is not keeping up; disconnecting".format(client.address))
+                        self.drop_client(client)
+
+    def run_server(self):
+        while True:
+            now = time.time()
+            for client in self.clients:
+                if client.streaming and now - client.last_write > self.STREAM_KEEPALIVE:
+                    client.queue(b": keepalive\n\n")
+            wlist = [client for client in self.clients if client.outbuf]
+            readable, writable, _ = select.select([self.listen_socket, self.wakeup_read] + self.clients, wlist, [],
+                                                  self.STREAM_KEEPALIVE)
+            for client in writable:
+                try:
+                    client.flush()
+                except socket.error:
+                    self.drop_client(client)
+                    continue
+                if client.close_when_sent and not client.outbuf:
+                    self.drop_client(client)
+            for r in readable:
+                if r is self.listen_socket:
+                    self.accept()
+                elif r is self.wakeup_read:
+                    self.send_events()
+                elif r in self.clients:
+                    self.read_client(r)
@@ -0,0 +1,158 @@
+#
+# Notifications (e.g. connection lost/regained) sent off the panel I/O thread
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import subprocess
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+
+class NotifyTimeout(Exception):
+    pass
+
+
+class ScriptBackend(object):
+    """Runs a script with the message as its only argument"""
+    def __init__(self, script):
+        self.script = script
+
+    def send(self, message, timeout):
+        process = subprocess.Popen([self.script, message])
+        deadline = time.time() + timeout
+        while process.poll() is None:
+            if time.time() > deadline:
+                process.kill()
+                process.wait()
+                raise NotifyTimeout("{} took longer than {:d} seconds".format(self.script, timeout))
+            time.sleep(0.05)
+        if process.returncode != 0:
+            raise RuntimeError("{} exited with status {:d}".format(self.script, process.returncode))
+
+    def __str__(self):
+        return self.script
+
+
+class WebhookBackend(object):
+    """POSTs {"message": message} as JSON to a URL"""
+    def __init__(self, url):
+        self.url = url
+
+    def send(self, message, timeout):
+        body = json.dumps({"message": message}).encode("utf-8")
+        request = Request(self.url, body, {"Content-Type": "application/json"})
+        urlopen(request, timeout=timeout).close()
+
+    def __str__(self):
+        return self.url
+
+
+class FileBackend(object):
+    """Appends a timestamped line to a file"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def send(self, message, timeout):
+        with open(self.filename, "a") as f:
+            f.write(time.strftime("%Y-%m-%d %X") + ": " + message + "\n")
+
+    def __str__(self):
+        return self.filename
+
+
+class Notifier(object):
+    """Sends notifications to each backend from a background thread, so a
+    slow or hung backend never holds up the panel connection.
+
+    A message identical to the last one sent is dropped, as is anything over
+    rate_limit messages in rate_period seconds."""
+
+    def __init__(self, backends, log, timeout=10, rate_limit=10, rate_period=3600):
+        self.backends = backends
+        self.log = log
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.last_sent = None
+        self.recent = collections.deque()
+        self.queue = queue.Queue()
+        self.stats = collections.Counter()
+        # how long each of the most recent deliveries took, in seconds
+        self.latencies = collections.deque(maxlen=100)
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def notify(self, message):
+        now = time.time()
+        if message == self.last_sent:
+            self.stats["duplicates"] += 1
+            return
+        while self.recent and now - self.recent[0] >= self.rate_period:
+            self.recent.popleft()
+        if len(self.recent) >= self.rate_limit:
+            self.stats["rate_limited"] += 1
+            self.log("Not sending notification '{}', over rate limit".format(message))
+            return
+        self.last_sent = message
+        self.recent.append(now)
+        self.queue.put((now, message))
+
+    def run(self):
+        while True:
+            queued, message = self.queue.get()
+            for backend in self.backends:
+                start = time.time()
+                try:
+                    backend.send(message, self.timeout)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    self.log("Notification '{}' to {} failed - {}".format(message, backend, e))
+                    continue
+                self.stats["sent"] += 1
+                self.latencies.append(time.time() - start)
+            self.log("Notification '{}' finished {:.1f} seconds after it was raised".format(
+                message, time.time() - queued))
+
+
+def notifier_from_environment(log):
+    """Build a Notifier from NOTIFY_SCRIPT (default ./send-message.sh, set
+    it empty to disable), NOTIFY_WEBHOOK and NOTIFY_FILE"""
+    backends = []
+    script = os.getenv('NOTIFY_SCRIPT', './send-message.sh')
+    if script:
+        backends.append(ScriptBackend(script))
+    if os.getenv('NOTIFY_WEBHOOK'):
+        backends.append(WebhookBackend(os.getenv('NOTIFY_WEBHOOK')))
+    if os.getenv('NOTIFY_FILE'):
+        backends.append(FileBackend(os.getenv('NOTIFY_FILE')))
+    return Notifier(backends, log, timeout=int(os.getenv('NOTIFY_TIMEOUT', 10)))
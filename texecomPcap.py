@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# Capture of Texecom panel traffic to pcap files, and a dissector for them
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Frames are wrapped in synthetic IPv4/TCP packets, one frame per packet,
+# so captures can be opened with wireshark/tcpdump ("Follow TCP stream"
+# works) as well as read back by read_pcap(). Each connection to the panel
+# starts a new TCP stream with its own handshake.
+#
+# usage: ./texecomPcap.py capture.pcap
+#   prints every frame in the capture, decoding messages from the panel
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import socket
+import struct
+import sys
+import time
+
+from texecomTrace import FrameTrace
+
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_RECORD = struct.Struct("<IIII")
+IP_HEADER = struct.Struct("!BBHHHBBH4s4s")
+TCP_HEADER = struct.Struct("!HHIIBBHHH")
+
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPE_RAW = 101
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+# the address we pretend to connect from; the panel's real address is used if it's an IPv4 address
+CLIENT_ADDRESS = "10.0.0.1"
+PANEL_ADDRESS = "10.0.0.2"
+
+
+def ip_checksum(header):
+    total = sum(struct.unpack("!10H", header))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class PcapWriter(object):
+    """Writes the frames recorded by a FrameTrace to a pcap file. Add
+    write_frame to the trace's listeners. Writes are buffered and flushed
+    at most once every flush_interval seconds; call flush_if_due()
+    regularly so the last frames are written out when traffic goes quiet"""
+
+    def __init__(self, filename, panel_host, panel_port, flush_interval=1):
+        self.f = open(filename, "wb", 65536)
+        self.f.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, 65535, LINKTYPE_RAW))
+        try:
+            self.panel_address = socket.inet_aton(panel_host)
+        except socket.error:
+            self.panel_address = socket.inet_aton(PANEL_ADDRESS)
+        self.client_address = socket.inet_aton(CLIENT_ADDRESS)
+        self.panel_port = panel_port
+        self.client_port = 40000
+        self.client_seq = 0
+        self.panel_seq = 0
+        self.ip_id = 0
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        self.unflushed = False
+        self.stream_open = False
+
+    def packet(self, timestamp, from_client, flags, data):
+        if from_client:
+            src, dst = self.client_address, self.panel_address
+            sport, dport = self.client_port, self.panel_port
+            seq, ack = self.client_seq, self.panel_seq
+        else:
+            src, dst = self.panel_address, self.client_address
+            sport, dport = self.panel_port, self.client_port
+            seq, ack = self.panel_seq, self.client_seq
+        tcp = TCP_HEADER.pack(sport, dport, seq, ack, 5 << 4, flags, 65535, 0, 0)
+        self.ip_id = (self.ip_id + 1) & 0xffff
+        length = IP_HEADER.size + len(tcp) + len(data)
+        ip = IP_HEADER.pack(0x45, 0, length, self.ip_id, 0, 64, socket.IPPROTO_TCP, 0, src, dst)
+        ip = ip[:10] + struct.pack("!H", ip_checksum(ip)) + ip[12:]
+        seconds = int(timestamp)
+        self.f.write(PCAP_RECORD.pack(seconds, int((timestamp - seconds) * 1000000), length, length))
+        self.f.write(ip)
+        self.f.write(tcp)
+        self.f.write(data)
+        # SYN and FIN use up a sequence number
+        used = len(data) + (1 if flags & (TCP_SYN | TCP_FIN) else 0)
+        if from_client:
+            self.client_seq = (self.client_seq + used) & 0xffffffff
+        else:
+            self.panel_seq = (self.panel_seq + used) & 0xffffffff
+
+    def new_stream(self, timestamp):
+        if self.stream_open:
+            self.packet(timestamp, True, TCP_FIN | TCP_ACK, b"")
+        self.client_port = 40000 + (self.client_port - 39999) % 20000
+        self.client_seq = 0
+        self.panel_seq = 0
+        self.packet(timestamp, True, TCP_SYN, b"")
+        self.packet(timestamp, False, TCP_SYN | TCP_ACK, b"")
+        self.packet(timestamp, True, TCP_ACK, b"")
+        self.stream_open = True
+
+    def write_frame(self, timestamp, direction, data):
+        if direction == FrameTrace.CONNECTED or not self.stream_open:
+            self.new_stream(timestamp)
+        if direction == FrameTrace.SENT and data[4:5] == b"\x01":
+            # don't write the UDL password from login commands to the capture
+            data = data[:5] + b"*" * (len(data) - 6) + data[-1:]
+        if data:
+            self.packet(timestamp, direction == FrameTrace.SENT, TCP_PSH | TCP_ACK, data)
+        self.unflushed = True
+        self.flush_if_due(timestamp)
+
+    def flush_if_due(self, now):
+        if self.unflushed and now - self.last_flush >= self.flush_interval:
+            self.f.flush()
+            self.unflushed = False
+            self.last_flush = now
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+
+def read_pcap(filename):
+    """Yield (timestamp, sent, data) for each frame in a capture written by
+    PcapWriter, where sent is True for frames sent to the panel"""
+    with open(filename, "rb") as f:
+        header = f.read(PCAP_HEADER.size)
+        if len(header) < PCAP_HEADER.size or PCAP_HEADER.unpack(header)[0] != PCAP_MAGIC:
+            raise ValueError("{} is not a pcap file written by PcapWriter".format(filename))
+        while True:
+            record = f.read(PCAP_RECORD.size)
+            if len(record) < PCAP_RECORD.size:
+                return
+            seconds, microseconds, length, _ = PCAP_RECORD.unpack(record)
+            packet = f.read(length)
+            if len(packet) < length:
+                # capture was cut off part way through a packet
+                return
+            ihl = (packet[0] & 0xf) * 4
+            offset = TCP_HEADER.unpack(packet[ihl:ihl + TCP_HEADER.size])[4]
+            data = packet[ihl + (offset >> 4) * 4:]
+            if data:
+                sent = packet[12:16] == socket.inet_aton(CLIENT_ADDRESS)
+                yield seconds + microseconds / 1000000.0, sent, data
+
+
+def dissect(tc, data):
+    """Describe a frame, using tc (a TexecomConnect) to decode messages"""
+    if len(data) < tc.LENGTH_HEADER + 2 or data[0] != tc.HEADER_START:
+        return "malformed frame: " + tc.hexstr(data)
+    msg_type, sequence = data[1], data[3]
+    body = memoryview(data)[tc.LENGTH_HEADER:-1]
+    if msg_type == tc.HEADER_TYPE_MESSAGE:
+        return "message seq {:d}: {}".format(sequence, tc.decode_message_to_text(body))
+    if msg_type in (tc.HEADER_TYPE_COMMAND, tc.HEADER_TYPE_RESPONSE):
+        command = command_name(tc, body[0])
+        kind = "command" if msg_type == tc.HEADER_TYPE_COMMAND else "response"
+        if body[0] == tc.CMD_LOGIN and msg_type == tc.HEADER_TYPE_COMMAND:
+            # don't show the UDL password
+            return "{} seq {:d}: {}".format(kind, sequence, command)
+        return "{} seq {:d}: {} {}".format(kind, sequence, command, tc.hexstr(body[1:]))
+    return "unknown frame type: " + tc.hexstr(data)
+
+
+def command_name(tc, cmd):
+    for name in dir(tc):
+        if name.startswith("CMD_") and not name.startswith("CMD_RESPONSE_") and \
+                name not in ("CMD_TIMEOUT", "CMD_RETRIES") and getattr(tc, name) == cmd:
+            return name[4:]
+    return "command {:02x}".format(cmd)
+
+
+if __name__ == '__main__':
+    from texecomConnect import TexecomConnect
+
+    tc = TexecomConnect(None, None, None, None)
+    for timestamp, sent, data in read_pcap(sys.argv[1]):
+        when = time.strftime("%Y-%m-%d %X", time.localtime(timestamp)) + ".{:03d}".format(int(timestamp * 1000) % 1000)
+        print("{} {} {}".format(when, "->" if sent else "<-", dissect(tc, data)))
@@ -0,0 +1,159 @@
+#
+# Per-stage counters and sampled timings of the work done for a Texecom panel
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# TexecomConnect marks the start and end of each stage of its work (socket
+# reads and writes, CRC checks, decoding, zone updates, handlers, ...) when
+# tc.profiling is on; when it's off the only cost is checking that
+# tc.active_profiler is None. Stages nest, e.g. "poll;handle_message;handler"
+# is the handler called for a message that arrived whilst polling.
+#
+# Every stage is counted, but only one in sample_every top level stages
+# (and the stages within them) are timed. The timings are written as folded
+# stacks, one "stage;stage;stage microseconds" line per stack, which
+# flamegraph.pl or speedscope turn into a flame graph:
+#
+#   flamegraph.pl --countname=us profile.folded > profile.svg
+#
+# With enable_signals(), SIGUSR1 turns profiling on and off and SIGUSR2
+# logs a summary and writes the folded stacks to a file.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import signal
+import time
+
+
+class Profiler(object):
+    """Counts and times the stages TexecomConnect marks with start() and
+    stop(); see the top of this file"""
+
+    SAMPLE_EVERY = 8
+
+    def __init__(self, sample_every=SAMPLE_EVERY):
+        self.sample_every = sample_every
+        self.operations = 0
+        self.sampling = False
+        # [stage, start time, time spent in the stages within it] for each stage in progress, if it's being timed
+        self.stack = []
+        self.counts = collections.defaultdict(int)
+        self.samples = collections.defaultdict(int)
+        # stage -> total time sampled, including the stages within it
+        self.times = collections.defaultdict(float)
+        # stack of stages joined with ";" -> time sampled in the last stage itself
+        self.folded = collections.defaultdict(float)
+        self.started = time.time()
+
+    def start(self, stage):
+        """Mark the start of stage. Returns the depth to pass to stop()"""
+        stack = self.stack
+        depth = len(stack)
+        if not depth:
+            self.operations += 1
+            self.sampling = self.operations % self.sample_every == 0
+        self.counts[stage] += 1
+        if self.sampling:
+            stack.append([stage, time.perf_counter(), 0])
+        else:
+            # only the depth matters until the next sampled stage
+            stack.append(stage)
+        return depth
+
+    def stop(self, depth):
+        """Mark the end of the stage start() returned depth for. Any stages
+        within it that weren't stopped, because of an exception, are dropped"""
+        stack = self.stack
+        if len(stack) <= depth:
+            return
+        if not self.sampling:
+            del stack[depth:]
+            return
+        elapsed = time.perf_counter() - stack[depth][1]
+        del stack[depth + 1:]
+        stage, _, within = stack.pop()
+        self.samples[stage] += 1
+        self.times[stage] += elapsed
+        self.folded[";".join([frame[0] for frame in stack] + [stage])] += elapsed - within
+        if stack:
+            stack[-1][2] += elapsed
+
+    def abandon(self):
+        """Drop the stages in progress, e.g. when the connection to the panel
+        is closed part way through them"""
+        del self.stack[:]
+
+    def summary(self):
+        """Counts and sampled timings for each stage, for logging or JSON"""
+        stages = {}
+        for stage, count in self.counts.items():
+            samples = self.samples.get(stage, 0)
+            stages[stage] = {
+                "count": count,
+                "sampled": samples,
+                "mean_us": round(self.times[stage] * 1e6 / samples, 1) if samples else None,
+            }
+        return {"since": self.started, "sample_every": self.sample_every, "stages": stages}
+
+    def folded_stacks(self):
+        """The sampled time in each stack, in whole microseconds, as lines
+        for flamegraph.pl"""
+        lines = []
+        for stack, elapsed in sorted(self.folded.items()):
+            microseconds = int(round(elapsed * 1e6))
+            if microseconds > 0:
+                lines.append("{} {:d}".format(stack, microseconds))
+        return lines
+
+    def write_folded(self, filename):
+        with open(filename, "w") as f:
+            for line in self.folded_stacks():
+                f.write(line + "\n")
+
+    def log_summary(self, log):
+        stages = self.summary()["stages"]
+        log("Profile since {}, timing 1 in {:d}:".format(
+            time.strftime("%Y-%m-%d %X", time.localtime(self.started)), self.sample_every))
+        for stage, counters in sorted(stages.items(), key=lambda item: -item[1]["count"]):
+            mean = counters["mean_us"]
+            log("  {:<16} {:>9d} {}".format(stage, counters["count"],
+                                              "{:.1f}us".format(mean) if mean is not None else "-"))
+
+
+def enable_signals(tc, filename):
+    """SIGUSR1 turns tc.profiling on and off, and SIGUSR2 logs the profile
+    and writes its folded stacks to filename. Signal handlers can only be
+    set from the main thread, so call this from there"""
+    def toggle(signum, frame):
+        tc.profiling = not tc.profiling
+        tc.log("Profiling " + ("on" if tc.profiling else "off"))
+
+    def dump(signum, frame):
+        if tc.profiler is None:
+            tc.log("Profiling has not been turned on; send SIGUSR1 first")
+            return
+        tc.profiler.log_summary(tc.log)
+        try:
+            tc.profiler.write_folded(filename)
+        except (IOError, OSError) as e:
+            tc.log("Failed to write profile - {}".format(e))
+            return
+        tc.log("Wrote folded stacks to " + filename)
+
+    signal.signal(signal.SIGUSR1, toggle)
+    signal.signal(signal.SIGUSR2, dump)
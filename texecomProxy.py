@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+#
+# Proxy allowing several local clients to share the single panel connection
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Clients connect over TCP or a unix socket and exchange newline delimited
+# JSON. Every message from the panel is sent to every client as:
+#
+#   {"event": "message", "type": 1, "payload": "0201", "text": "Zone event message: ..."}
+#
+# and clients can query the panel by sending:
+#
+#   {"id": 1, "command": "get_lcd_display", "priority": "interactive"}
+#
+# which is answered with {"id": 1, "result": ...} or {"id": 1, "error": "..."}.
+# Queries are run one at a time by the panel's CommandScheduler, highest
+# priority first ("interactive" or "background"), and identical
+# queries waiting to be run are merged so the panel only answers them once.
+# Recent answers to the queries in TexecomConnect.QUERY_CACHE_TTL are
+# returned straight from the cache.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import binascii
+import collections
+import json
+import os
+import select
+import socket
+import sys
+import time
+
+from texecomConnect import CommandScheduler, TexecomConnect, Unbuffered
+
+
+def to_text(s):
+    """Panel strings are binary; make them safe to put in JSON"""
+    if isinstance(s, bytes):
+        return s.decode("latin-1")
+    return s
+
+
+class ProxyClient(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbuf = b""
+        self.outbuf = collections.deque()
+        self.outbytes = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def queue(self, message):
+        data = (json.dumps(message, sort_keys=True) + "\n").encode("utf-8")
+        self.outbuf.append(data)
+        self.outbytes += len(data)
+
+    def flush(self):
+        while self.outbuf:
+            data = self.outbuf[0]
+            sent = self.sock.send(data)
+            self.outbytes -= sent
+            if sent < len(data):
+                self.outbuf[0] = data[sent:]
+                return
+            self.outbuf.popleft()
+
+
+class ProxyRequest(object):
+    def __init__(self, command, priority):
+        self.command = command
+        self.priority = priority
+        # (client, request id) pairs waiting for the answer
+        self.waiters = []
+        self.answered = False
+
+
+class PanelProxy(object):
+    """Holds the one connection the panel allows and shares it between any
+    number of local clients"""
+
+    # panel queries clients may make
+    QUERIES = ("get_date_time", "get_lcd_display", "get_log_pointer", "get_panel_identification",
+               "get_system_power")
+    PRIORITIES = {"interactive": CommandScheduler.INTERACTIVE, "background": CommandScheduler.BULK}
+    # a client that has this many bytes waiting to be sent to it is too slow and is disconnected
+    MAX_CLIENT_BUFFER = 256 * 1024
+    RECONNECT_DELAY = 5
+
+    def __init__(self, host, port, udl_password, listen_socket):
+        self.tc = TexecomConnect(host, port, udl_password, self.message_handler)
+        self.listen_socket = listen_socket
+        self.listen_socket.setblocking(False)
+        self.clients = []
+        self.pending = {}
+        self.next_attempt = 0
+        self.connected = False
+
+    def message_handler(self, payload):
+        text = self.tc.decode_message_to_text(payload)
+        self.tc.log(text)
+        msg_type = payload[0]
+        zone_event = self.tc.parse_zone_event(payload) if msg_type == self.tc.MSG_ZONEEVENT else None
+        if zone_event is not None:
+            zone = self.tc.get_zone(zone_event[0])
+            zone.state = zone_event[1] & 0x3
+            zone.active = zone.state == 1
+        self.broadcast({
+            "event": "message",
+            "type": msg_type,
+            "payload": binascii.hexlify(payload[1:]).decode("ascii"),
+            "text": to_text(text),
+        })
+
+    def broadcast(self, message):
+        for client in list(self.clients):
+            self.send(client, message)
+
+    def send(self, client, message):
+        if client not in self.clients:
+            return
+        client.queue(message)
+        if client.outbytes > self.MAX_CLIENT_BUFFER:
+            self.tc.log("proxy client {} is not keeping up; disconnecting".format(client.address))
+            self.drop_client(client)
+
+    def drop_client(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        client.sock.close()
+
+    def accept(self):
+        try:
+            sock, address = self.listen_socket.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        client = ProxyClient(sock, address or "unix socket")
+        self.clients.append(client)
+        self.tc.log("proxy client {} connected".format(client.address))
+
+    def read_client(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error:
+            data = b""
+        if not data:
+            self.tc.log("proxy client {} disconnected".format(client.address))
+            self.drop_client(client)
+            return
+        client.inbuf += data
+        while b"\n" in client.inbuf:
+            line, client.inbuf = client.inbuf.split(b"\n", 1)
+            if line.strip():
+                self.handle_request(client, line)
+
+    def handle_request(self, client, line):
+        try:
+            request = json.loads(line.decode("utf-8"))
+            request_id = request.get("id")
+            command = request["command"]
+            priority = self.PRIORITIES[request.get("priority", "interactive")]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send(client, {"error": "malformed request"})
+            return
+        # none of the queries take arguments
+        if command not in self.QUERIES or request.get("args"):
+            self.send(client, {"id": request_id, "error": "unknown command"})
+            return
+        if self.tc.s is None:
+            self.send(client, {"id": request_id, "error": "panel not connected"})
+            return
+        if command in self.tc.QUERY_CACHE_TTL:
+            result = self.tc.query_cache.peek(command)
+            if result is not None:
+                self.send(client, self.reply(request_id, result))
+                return
+        if command not in self.pending:
+            self.pending[command] = ProxyRequest(command, priority)
+        elif priority >= self.pending[command].priority:
+            self.pending[command].waiters.append((client, request_id))
+            return
+        # new request, or one already queued that now needs to run sooner
+        request = self.pending[command]
+        request.priority = priority
+        request.waiters.append((client, request_id))
+        self.tc.scheduler.submit(priority, self.run_request, request)
+
+    def run_request(self, request):
+        if request.answered:
+            # also queued at a higher priority, and has already been run
+            return
+        if request.command in self.tc.QUERY_CACHE_TTL:
+            result = self.tc.cached_query(request.command)
+        else:
+            result = getattr(self.tc, request.command)()
+        request.answered = True
+        if self.pending.get(request.command) is request:
+            del self.pending[request.command]
+        for client, request_id in request.waiters:
+            self.send(client, self.reply(request_id, result))
+
+    @staticmethod
+    def reply(request_id, result):
+        if result is None:
+            return {"id": request_id, "error": "panel did not respond"}
+        elif isinstance(result, tuple):
+            return {"id": request_id, "result": [to_text(value) for value in result]}
+        return {"id": request_id, "result": to_text(result)}
+
+    def fail_queued_commands(self):
+        for request in self.pending.values():
+            for client, request_id in request.waiters:
+                self.send(client, {"id": request_id, "error": "panel not connected"})
+        self.pending = {}
+
+    def run_panel(self, func, *args):
+        try:
+            return func(*args)
+        except socket.timeout:
+            return None
+        except socket.error as e:
+            self.tc.log("Socket error - {}; closing socket".format(e))
+            self.tc.closesocket()
+            return None
+
+    def check_panel(self):
+        if self.tc.s is None and self.connected:
+            self.connected = False
+            self.fail_queued_commands()
+            self.broadcast({"event": "disconnected"})
+            self.next_attempt = time.time() + self.RECONNECT_DELAY
+        if self.tc.s is not None or time.time() < self.next_attempt:
+            return
+        if not self.tc.start_session():
+            self.next_attempt = time.time() + self.RECONNECT_DELAY
+            return
+        self.run_panel(self.tc.load_panel_data)
+        if self.tc.s is not None:
+            self.connected = True
+            self.broadcast({"event": "connected"})
+        else:
+            self.next_attempt = time.time() + self.RECONNECT_DELAY
+
+    def run_once(self, timeout=1):
+        self.check_panel()
+        if self.tc.s is not None:
+            self.run_panel(self.tc.service)
+            self.run_panel(self.tc.scheduler.run)
+
+        rlist = [self.listen_socket] + self.clients
+        if self.tc.s is not None:
+            rlist += [self.tc, self.tc.scheduler]
+            timeout = self.tc.wait_timeout(timeout)
+        wlist = [client for client in self.clients if client.outbuf]
+        readable, writable, _ = select.select(rlist, wlist, [], timeout)
+        for client in writable:
+            try:
+                client.flush()
+            except socket.error:
+                self.drop_client(client)
+        for r in readable:
+            if r is self.listen_socket:
+                self.accept()
+            elif r is self.tc:
+                self.run_panel(self.tc.poll)
+            elif r in self.clients:
+                self.read_client(r)
+
+    def run(self):
+        while True:
+            self.run_once()
+
+
+def make_listen_socket(address):
+    """address is either a path for a unix socket, or host:port"""
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+    sock.listen(16)
+    return sock
+
+
+if __name__ == '__main__':
+    texhost = os.getenv('TEXHOST','192.168.1.9')
+    texport = int(os.getenv('TEXPORT',10001))
+    udlpassword = os.getenv('UDLPASSWORD','1234')
+    listen = os.getenv('PROXY_LISTEN','127.0.0.1:10002')
+
+    sys.stdout = Unbuffered(sys.stdout)
+    proxy = PanelProxy(texhost, texport, udlpassword, make_listen_socket(listen))
+    proxy.run()
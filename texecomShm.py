@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+#
+# Export of live panel state to a memory-mapped file for other local processes
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The file (put it on a tmpfs such as /dev/shm) has a fixed layout, all
+# little endian:
+#
+#   offset  size
+#        0    56  header:
+#                   4s  magic "TXSM"
+#                   H   layout version (1)
+#                   H   number of zone slots (640)
+#                   H   number of area slots (64)
+#                   B   1 if connected to the panel
+#                   B   1 if the power readings are valid
+#                   I   sequence number, odd whilst an update is in progress
+#                   d   time of the last update
+#                   d   time the connection to the panel last went up or down
+#                   d   time of the power readings
+#                   f   system voltage
+#                   f   battery voltage
+#                   i   system current (mA)
+#                   i   battery current (mA)
+#       56  16*640  zone slots, for zone 1 onwards:
+#                   B   zone bitmap from the last zone event (bits 0-1: 0 secure, 1 active, 2 tamper, 3 short)
+#                   B   zone type, 0 if unused or not yet read
+#                   6x
+#                   d   time of the last zone event, 0 if none
+#            16*64  area slots, for area 1 onwards:
+#                   B   area state from the last area event (0 disarmed, 1 in exit, 2 in entry,
+#                       3 armed, 4 part armed, 5 in alarm)
+#                   7x
+#                   d   time of the last area event, 0 if none
+#
+# Updates use a seqlock: the writer makes the sequence number odd, changes
+# the data, then makes it even again. A reader copies the whole file and
+# retries if the sequence number was odd or changed during the copy; that
+# needs no locks or system calls once the file is mapped.
+#
+# usage: ./texecomShm.py /dev/shm/texecom
+#   prints a snapshot of the state as JSON
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"TXSM"
+LAYOUT_VERSION = 1
+ZONE_SLOTS = 640
+AREA_SLOTS = 64
+
+HEADER = struct.Struct("<4sHHHBBIdddffii")
+SEQUENCE = struct.Struct("<I")
+SEQUENCE_OFFSET = 12
+UPDATED = struct.Struct("<d")
+UPDATED_OFFSET = 16
+LINK = struct.Struct("<B")
+LINK_OFFSET = 10
+LINK_CHANGED_OFFSET = 24
+POWER = struct.Struct("<dffii")
+POWER_VALID_OFFSET = 11
+POWER_OFFSET = 32
+ZONE = struct.Struct("<BB6xd")
+AREA = struct.Struct("<B7xd")
+ZONES_OFFSET = HEADER.size
+AREAS_OFFSET = ZONES_OFFSET + ZONE.size * ZONE_SLOTS
+SIZE = AREAS_OFFSET + AREA.size * AREA_SLOTS
+
+
+class StateExport(object):
+    """Writes the panel state to a memory-mapped file; see the layout above"""
+
+    def __init__(self, filename):
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self.mm = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+        self.sequence = SEQUENCE.unpack_from(self.mm, SEQUENCE_OFFSET)[0]
+        self.begin()
+        self.mm[0:SEQUENCE_OFFSET] = b"\0" * SEQUENCE_OFFSET
+        self.mm[UPDATED_OFFSET:SIZE] = b"\0" * (SIZE - UPDATED_OFFSET)
+        struct.pack_into("<4sHHH", self.mm, 0, MAGIC, LAYOUT_VERSION, ZONE_SLOTS, AREA_SLOTS)
+        self.end()
+
+    def begin(self):
+        # carries on from whatever sequence number a previous writer left, so readers never see it go backwards
+        self.sequence |= 1
+        SEQUENCE.pack_into(self.mm, SEQUENCE_OFFSET, self.sequence & 0xffffffff)
+
+    def end(self):
+        UPDATED.pack_into(self.mm, UPDATED_OFFSET, time.time())
+        self.sequence += 1
+        SEQUENCE.pack_into(self.mm, SEQUENCE_OFFSET, self.sequence & 0xffffffff)
+
+    def zone(self, zone_number, zone_bitmap):
+        if not 1 <= zone_number <= ZONE_SLOTS:
+            return
+        offset = ZONES_OFFSET + (zone_number - 1) * ZONE.size
+        self.begin()
+        zone_type = ZONE.unpack_from(self.mm, offset)[1]
+        ZONE.pack_into(self.mm, offset, zone_bitmap, zone_type, time.time())
+        self.end()
+
+    def zone_type(self, zone_number, zone_type):
+        if not 1 <= zone_number <= ZONE_SLOTS:
+            return
+        offset = ZONES_OFFSET + (zone_number - 1) * ZONE.size
+        self.begin()
+        self.mm[offset + 1:offset + 2] = struct.pack("<B", zone_type)
+        self.end()
+
+    def area(self, area_number, area_state):
+        if not 1 <= area_number <= AREA_SLOTS:
+            return
+        self.begin()
+        AREA.pack_into(self.mm, AREAS_OFFSET + (area_number - 1) * AREA.size, area_state, time.time())
+        self.end()
+
+    def power(self, power):
+        system_voltage, battery_voltage, system_current, battery_current = power
+        self.begin()
+        LINK.pack_into(self.mm, POWER_VALID_OFFSET, 1)
+        POWER.pack_into(self.mm, POWER_OFFSET, time.time(), system_voltage, battery_voltage,
+                        system_current, battery_current)
+        self.end()
+
+    def link(self, up):
+        if LINK.unpack_from(self.mm, LINK_OFFSET)[0] == int(up):
+            return
+        self.begin()
+        LINK.pack_into(self.mm, LINK_OFFSET, int(up))
+        UPDATED.pack_into(self.mm, LINK_CHANGED_OFFSET, time.time())
+        self.end()
+
+    def close(self):
+        self.mm.close()
+
+
+class StateReader(object):
+    """Reads consistent snapshots of a file written by StateExport"""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from("<4sH", self.mm, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION or len(self.mm) < SIZE:
+            raise ValueError("{} isn't a version {:d} state file".format(filename, LAYOUT_VERSION))
+
+    def read(self, retries=10000):
+        """Return a consistent copy of the file's contents"""
+        for _ in range(retries):
+            before = SEQUENCE.unpack_from(self.mm, SEQUENCE_OFFSET)[0]
+            if before & 1:
+                continue
+            data = self.mm[:SIZE]
+            if SEQUENCE.unpack_from(self.mm, SEQUENCE_OFFSET)[0] == before:
+                return data
+        raise RuntimeError("state is changing too often to get a consistent snapshot")
+
+    def snapshot(self):
+        data = self.read()
+        (_, _, zone_slots, area_slots, link_up, power_valid, sequence, updated, link_changed, power_time,
+         system_voltage, battery_voltage, system_current, battery_current) = HEADER.unpack_from(data, 0)
+        zones = {}
+        for slot in range(zone_slots):
+            zone_bitmap, zone_type, changed = ZONE.unpack_from(data, ZONES_OFFSET + slot * ZONE.size)
+            if zone_type or changed:
+                zones[slot + 1] = {"bitmap": zone_bitmap, "state": zone_bitmap & 0x3, "type": zone_type,
+                                   "changed": changed}
+        areas = {}
+        for slot in range(area_slots):
+            area_state, changed = AREA.unpack_from(data, AREAS_OFFSET + slot * AREA.size)
+            if changed:
+                areas[slot + 1] = {"state": area_state, "changed": changed}
+        power = None
+        if power_valid:
+            power = {"time": power_time, "system_voltage": system_voltage, "battery_voltage": battery_voltage,
+                     "system_current": system_current, "battery_current": battery_current}
+        return {
+            "sequence": sequence,
+            "updated": updated,
+            "link": {"up": bool(link_up), "changed": link_changed},
+            "power": power,
+            "zones": zones,
+            "areas": areas,
+        }
+
+    def close(self):
+        self.mm.close()
+
+
+if __name__ == '__main__':
+    reader = StateReader(sys.argv[1])
+    print(json.dumps(reader.snapshot(), indent=2, sort_keys=True))
@@ -0,0 +1,305 @@
+#
+# Fan-out of panel events to independent sinks (MQTT, files, webhooks, ...)
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Each sink has its own queue and worker thread. The panel reader only
+# builds the event once and puts it on every sink's queue, so a slow or
+# failing sink delays (and eventually drops) its own events and nothing
+# else.
+#
+# Events are dicts:
+#   {"time": 1530000000.0, "type": 1, "payload": "0a01", "text": "Zone event message: ..."}
+# with, for zone events, "zone", "zone_name" and "zone_state", for area
+# events, "area", "area_name" and "area_state" and, for output events,
+# "output", "output_name", "output_state" and "output_changed" (the bits
+# that changed) added. Output events that change nothing aren't passed on.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import binascii
+import collections
+import json
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+
+def make_event(tc, payload):
+    """Build the event passed to the sinks for a message from the panel"""
+    msg_type = payload[0]
+    event = {
+        "time": time.time(),
+        "type": msg_type,
+        "payload": binascii.hexlify(payload[1:]).decode("ascii"),
+        "text": tc.decode_message_to_text(payload),
+    }
+    zone_event = tc.parse_zone_event(payload) if msg_type == tc.MSG_ZONEEVENT else None
+    if zone_event is not None:
+        zone_number, zone_bitmap = zone_event
+        zone = tc.zone.get(zone_number)
+        event["zone"] = zone_number
+        event["zone_name"] = zone.text if zone is not None else None
+        event["zone_state"] = zone_bitmap & 0x3
+    elif msg_type == tc.MSG_AREAEVENT and len(payload) >= 3:
+        area = tc.area.get(payload[1])
+        event["area"] = payload[1]
+        event["area_name"] = area.name if area is not None else None
+        event["area_state"] = payload[2]
+    elif msg_type == tc.MSG_OUTPUTEVENT and len(payload) >= 3:
+        event["output"] = payload[1]
+        event["output_name"] = tc.output_location_name(payload[1])
+        event["output_state"] = payload[2]
+        event["output_changed"] = tc.outputs.changed.get(payload[1], 0)
+    return event
+
+
+class Sink(object):
+    """Base class for sinks; subclasses implement write(events).
+
+    Events are delivered in batches of up to batch_size. If write() raises,
+    the batch is retried up to retries times, waiting retry_delay seconds
+    and doubling the wait each time, before being dropped. Once max_queue
+    events are waiting new ones are dropped."""
+
+    def __init__(self, name, batch_size=1, max_queue=1000, retries=3, retry_delay=1):
+        self.name = name
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue(max_queue)
+        self.log = None
+        self.stats = collections.Counter()
+        self.last_error = None
+        self.last_delivery = None
+        self.healthy = True
+        self.worker = None
+
+    def start(self, log):
+        self.log = log
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def write(self, events):
+        raise NotImplementedError
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch[-1] is None:
+                # close() was called; deliver whatever came before it
+                batch.pop()
+                if batch:
+                    self.deliver(batch)
+                return
+            self.deliver(batch)
+
+    def deliver(self, batch):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.stats["retries"] += 1
+                time.sleep(delay)
+                delay *= 2
+            try:
+                self.write(batch)
+            except Exception as e:
+                self.last_error = str(e)
+                continue
+            self.stats["delivered"] += len(batch)
+            self.last_delivery = time.time()
+            if not self.healthy:
+                self.log("Sink {} recovered".format(self.name))
+                self.healthy = True
+            return
+        self.stats["failed"] += len(batch)
+        if self.healthy:
+            self.log("Sink {} failing, dropped {:d} events - {}".format(self.name, len(batch), self.last_error))
+            self.healthy = False
+
+    def health(self):
+        return {
+            "healthy": self.healthy,
+            "queued": self.queue.qsize(),
+            "delivered": self.stats["delivered"],
+            "failed": self.stats["failed"],
+            "dropped": self.stats["dropped"],
+            "retries": self.stats["retries"],
+            "last_error": self.last_error,
+            "last_delivery": self.last_delivery,
+        }
+
+    def close(self, timeout=5):
+        """Stop the worker once the events already queued are delivered"""
+        if self.worker is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.worker.join(timeout)
+        self.worker = None
+
+
+class FileSink(Sink):
+    """Appends the text of each event to a file"""
+    def __init__(self, filename, **kwargs):
+        kwargs.setdefault("batch_size", 100)
+        super(FileSink, self).__init__("file:" + filename, **kwargs)
+        self.filename = filename
+
+    def write(self, events):
+        with open(self.filename, "a") as f:
+            for event in events:
+                when = time.strftime("%Y-%m-%d %X", time.localtime(event["time"]))
+                f.write(when + ": " + event["text"] + "\n")
+
+
+class JournalSink(Sink):
+    """Appends each event as a line of JSON to a file, synced to disk after
+    every batch so the journal survives a crash"""
+    def __init__(self, filename, **kwargs):
+        kwargs.setdefault("batch_size", 100)
+        super(JournalSink, self).__init__("journal:" + filename, **kwargs)
+        self.filename = filename
+
+    def write(self, events):
+        with open(self.filename, "a") as f:
+            for event in events:
+                f.write(json.dumps(event, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class WebhookSink(Sink):
+    """POSTs batches of events to a URL as a JSON list"""
+    def __init__(self, url, timeout=10, **kwargs):
+        kwargs.setdefault("batch_size", 20)
+        super(WebhookSink, self).__init__("webhook:" + url, **kwargs)
+        self.url = url
+        self.timeout = timeout
+
+    def write(self, events):
+        body = json.dumps(events).encode("utf-8")
+        request = Request(self.url, body, {"Content-Type": "application/json"})
+        urlopen(request, timeout=self.timeout).close()
+
+
+class MetricsSink(Sink):
+    """Counts events by message type, zone and area"""
+    TYPE_NAMES = {0: "debug", 1: "zone", 2: "area", 3: "output", 4: "user", 5: "log"}
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("batch_size", 100)
+        super(MetricsSink, self).__init__("metrics", **kwargs)
+        self.lock = threading.Lock()
+        self.types = collections.Counter()
+        self.zones = collections.Counter()
+        self.areas = collections.Counter()
+
+    def write(self, events):
+        with self.lock:
+            for event in events:
+                self.types[self.TYPE_NAMES.get(event["type"], str(event["type"]))] += 1
+                if "zone" in event:
+                    self.zones[event["zone"]] += 1
+                if "area" in event:
+                    self.areas[event["area"]] += 1
+
+    def health(self):
+        health = super(MetricsSink, self).health()
+        with self.lock:
+            health["types"] = dict(self.types)
+            health["zones"] = dict(self.zones)
+            health["areas"] = dict(self.areas)
+        return health
+
+
+class MqttSink(Sink):
+    """Publishes events using a paho MQTT client. messages_func(event)
+    returns a list of (topic, payload) to publish for the event"""
+    def __init__(self, client, messages_func, **kwargs):
+        super(MqttSink, self).__init__("mqtt", **kwargs)
+        self.client = client
+        self.messages_func = messages_func
+
+    def write(self, events):
+        for event in events:
+            for topic, payload in self.messages_func(event):
+                info = self.client.publish(topic, payload)
+                if info.rc != 0:
+                    raise IOError("publish to {} failed with error {:d}".format(topic, info.rc))
+
+
+class SinkPipeline(object):
+    """Passes every event to each of its sinks"""
+    def __init__(self, log):
+        self.log = log
+        self.sinks = []
+
+    def add(self, sink):
+        sink.start(self.log)
+        self.sinks.append(sink)
+
+    def dispatch(self, event):
+        for sink in self.sinks:
+            sink.submit(event)
+
+    def health(self):
+        return dict((sink.name, sink.health()) for sink in self.sinks)
+
+    def close(self, timeout=5):
+        for sink in self.sinks:
+            sink.close(timeout)
+
+
+def sinks_from_environment():
+    """Sinks configured by SINK_FILE, SINK_JOURNAL and SINK_WEBHOOK"""
+    sinks = []
+    if os.getenv('SINK_FILE'):
+        sinks.append(FileSink(os.getenv('SINK_FILE')))
+    if os.getenv('SINK_JOURNAL'):
+        sinks.append(JournalSink(os.getenv('SINK_JOURNAL')))
+    if os.getenv('SINK_WEBHOOK'):
+        sinks.append(WebhookSink(os.getenv('SINK_WEBHOOK')))
+    return sinks
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#
+# Supervisor to monitor several Texecom panels from a single process
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import fcntl
+import json
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from texecomConnect import TexecomConnect, Unbuffered
+
+
+class SupervisedPanel(TexecomConnect):
+    """A TexecomConnect that is driven by a PanelSupervisor rather than by
+    its own event_loop"""
+    def __init__(self, name, host, port, udl_password, message_handler_func):
+        super(SupervisedPanel, self).__init__(host, port, udl_password, message_handler_func)
+        self.name = name
+        self.next_attempt = 0
+        # set whilst the panel's worker thread is waiting for the panel; the supervisor leaves it alone until then
+        self.busy = False
+        # (func, finished) for the worker thread to run, see PanelSupervisor.start_work()
+        self.work = queue.Queue()
+
+    def log(self, string):
+        TexecomConnect.log("[" + self.name + "] " + string)
+
+    def start(self):
+        """Start a session and read the panel's details. Returns True if it's
+        still connected afterwards"""
+        if not self.start_session():
+            return False
+        # the site data is queued as bulk work, which is run a burst at a time
+        self.load_panel_data()
+        return self.s is not None
+
+
+class SupervisorMetrics(object):
+    """Counters shared by all the panels run by a supervisor"""
+    def __init__(self):
+        self.started = time.time()
+        self.panels = collections.OrderedDict()
+
+    def add_panel(self, name):
+        self.panels[name] = {
+            "connected": False,
+            "sessions": 0,
+            "session_failures": 0,
+            "disconnects": 0,
+            "messages": 0,
+            "last_message": None,
+        }
+
+    def count(self, name, counter, n=1):
+        self.panels[name][counter] += n
+
+    def set(self, name, key, value):
+        self.panels[name][key] = value
+
+    def snapshot(self):
+        return {
+            "uptime": int(time.time() - self.started),
+            "panels": dict((name, dict(values)) for name, values in self.panels.items()),
+        }
+
+
+class PanelSupervisor(object):
+    """Runs the connections to several panels from one select() loop.
+
+    Each panel has its own TexecomConnect, and so its own zone/area/user
+    tables and message handler. Panels are serviced round robin and each one
+    handles at most 'quantum' messages per pass, so a busy panel can't starve
+    the others.
+
+    Anything that waits for a panel to answer (connecting, logging in and
+    its scheduled commands) is run on that panel's own worker thread, so a
+    panel that is unreachable or has stopped answering never holds up the
+    rest. The loop doesn't touch a panel whilst its worker is busy with it."""
+
+    # how long to wait before reconnecting to a panel after a failure
+    RECONNECT_DELAY = 5
+    # how often the metrics are written to the log
+    METRICS_INTERVAL = 300
+
+    def __init__(self, quantum=10):
+        self.quantum = quantum
+        self.panels = collections.deque()
+        self.metrics = SupervisorMetrics()
+        self.last_metrics_log = time.time()
+        # (panel, result, finished) for work the worker threads have done, handled by the loop
+        self.finished = collections.deque()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def add_panel(self, name, host, port, udl_password, message_handler_func=None):
+        """Add a panel to be monitored. If message_handler_func is None, the
+        panel's messages are logged and used to track zone activity"""
+        panel = SupervisedPanel(name, host, port, udl_password, None)
+        if message_handler_func is None:
+            message_handler_func = self.default_message_handler(panel)
+        panel.message_handler_func = message_handler_func
+        self.panels.append(panel)
+        self.metrics.add_panel(name)
+        worker = threading.Thread(target=self.run_worker, args=(panel,))
+        worker.daemon = True
+        worker.start()
+        return panel
+
+    @staticmethod
+    def default_message_handler(panel):
+        def message_handler(payload):
+            panel.log(panel.decode_message_to_text(payload))
+            zone_event = panel.parse_zone_event(payload) if payload[0] == panel.MSG_ZONEEVENT else None
+            if zone_event is not None:
+                zone_number, zone_bitmap = zone_event
+                zone = panel.get_zone(zone_number)
+                zone.state = zone_bitmap & 0x3
+                zone.active = zone.state == 1
+        return message_handler
+
+    def start_work(self, panel, func, finished=None):
+        """Run func on the panel's worker thread. Once it's done,
+        finished(panel, result) is called from the loop"""
+        panel.busy = True
+        panel.work.put((func, finished))
+
+    def run_worker(self, panel):
+        while True:
+            func, finished = panel.work.get()
+            panel.panel_thread = threading.current_thread()
+            try:
+                result = self.run_panel(panel, func)
+            except Exception as e:
+                panel.log("Failed - {}; closing socket".format(e))
+                panel.closesocket()
+                result = None
+            self.finished.append((panel, result, finished))
+            try:
+                os.write(self.wakeup_write, b"x")
+            except OSError:
+                # pipe is full, so the loop has plenty of wake ups waiting already
+                pass
+
+    def finish_work(self):
+        try:
+            while os.read(self.wakeup_read, 512):
+                pass
+        except OSError:
+            pass
+        while self.finished:
+            panel, result, finished = self.finished.popleft()
+            panel.busy = False
+            panel.panel_thread = threading.current_thread()
+            if finished is not None:
+                finished(panel, result)
+
+    def panel_started(self, panel, started):
+        if not started:
+            self.metrics.count(panel.name, "session_failures")
+            panel.next_attempt = time.time() + self.RECONNECT_DELAY
+            return
+        self.metrics.count(panel.name, "sessions")
+        self.metrics.set(panel.name, "connected", True)
+
+    def run_panel(self, panel, func, *args):
+        """Call func, making sure a socket failure only affects the panel it
+        happened on"""
+        try:
+            return func(*args)
+        except socket.timeout:
+            # a frame arrived only partially; we'll pick up from the next one
+            return None
+        except socket.error as e:
+            panel.log("Socket error - {}; closing socket".format(e))
+            panel.closesocket()
+            return None
+
+    def check_connections(self):
+        for panel in self.panels:
+            if panel.busy:
+                continue
+            if panel.s is None and self.metrics.panels[panel.name]["connected"]:
+                panel.log("Connection lost")
+                self.metrics.set(panel.name, "connected", False)
+                self.metrics.count(panel.name, "disconnects")
+                panel.next_attempt = time.time() + self.RECONNECT_DELAY
+
+    def log_metrics(self):
+        if time.time() - self.last_metrics_log < self.METRICS_INTERVAL:
+            return
+        self.last_metrics_log = time.time()
+        TexecomConnect.log("Supervisor metrics: " + json.dumps(self.metrics.snapshot(), sort_keys=True))
+
+    def run_once(self, timeout=1):
+        self.finish_work()
+        self.check_connections()
+        now = time.time()
+        for panel in self.panels:
+            if not panel.busy and panel.s is None and now >= panel.next_attempt:
+                self.start_work(panel, panel.start, self.panel_started)
+        for panel in self.panels:
+            if not panel.busy and panel.s is not None:
+                self.run_panel(panel, panel.service)
+                if panel.s is not None and panel.scheduler.pending():
+                    self.start_work(panel, panel.scheduler.run)
+        self.check_connections()
+
+        connected = [panel for panel in self.panels if not panel.busy and panel.s is not None]
+        if connected:
+            timeout = min(panel.wait_timeout(timeout) for panel in connected)
+        rlist = [self.wakeup_read] + connected + [panel.scheduler for panel in connected]
+        readable, _, _ = select.select(rlist, [], [], timeout)
+        for panel in readable:
+            if not isinstance(panel, SupervisedPanel):
+                # a scheduler or a worker finishing; dealt with at the start of the next pass
+                continue
+            handled = self.run_panel(panel, panel.poll, self.quantum)
+            if handled:
+                self.metrics.count(panel.name, "messages", handled)
+                self.metrics.set(panel.name, "last_message", int(time.time()))
+        # start the next pass with a different panel so none is always last
+        self.panels.rotate(-1)
+        self.check_connections()
+        self.log_metrics()
+
+    def run(self):
+        while True:
+            self.run_once()
+
+
+def load_config(filename):
+    """Read a JSON config file of the form:
+
+    {"panels": [{"name": "home", "host": "192.168.1.9", "port": 10001, "udl_password": "1234"}, ...]}
+    """
+    with open(filename) as f:
+        config = json.load(f)
+    return config["panels"]
+
+
+if __name__ == '__main__':
+    config_file = sys.argv[1] if len(sys.argv) > 1 else os.getenv('SUPERVISOR_CONFIG', 'panels.json')
+
+    sys.stdout = Unbuffered(sys.stdout)
+    supervisor = PanelSupervisor(quantum=int(os.getenv('SUPERVISOR_QUANTUM', 10)))
+    for panel_config in load_config(config_file):
+        supervisor.add_panel(panel_config["name"], panel_config["host"], int(panel_config.get("port", 10001)),
+                             panel_config["udl_password"])
+    supervisor.run()
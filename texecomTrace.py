@@ -0,0 +1,101 @@
+#
+# Low overhead tracing of the frames exchanged with a Texecom panel
+#
+# Copyright (C) 2018 Joseph Heenan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class FrameTrace(object):
+    """Keeps the most recent frames sent to and received from the panel.
+
+    Recording a frame only appends a tuple to a bounded deque, which is
+    atomic, so the panel I/O thread never takes a lock or formats anything.
+    Frames are only turned into text when they are dumped (e.g. after an
+    error), or by a background thread if printing of all traffic is on."""
+    SENT = "Sent"
+    RECEIVED = "Received"
+    # recorded, with no data, each time a new connection is made to the panel
+    CONNECTED = "Connected"
+
+    def __init__(self, capacity=256):
+        self.frames = collections.deque(maxlen=capacity)
+        self.print_queue = None
+        self.printer = None
+        # functions called with (timestamp, direction, data) for every frame, e.g. PcapWriter.write_frame
+        self.listeners = []
+
+    def record(self, direction, data):
+        frame = (time.time(), direction, data)
+        self.frames.append(frame)
+        if self.print_queue is not None:
+            self.print_queue.put(frame)
+        for listener in self.listeners:
+            listener(*frame)
+
+    def recent(self, count=None):
+        frames = list(self.frames)
+        if count is not None:
+            frames = frames[-count:]
+        return frames
+
+    @staticmethod
+    def format_frame(frame):
+        # hexdump is only needed when frames are turned into text, so don't import it until then
+        import hexdump
+        timestamp, direction, data = frame
+        when = time.strftime("%Y-%m-%d %X", time.localtime(timestamp)) + ".{:03d}".format(int(timestamp * 1000) % 1000)
+        return "{} {} {:d} bytes:\n{}".format(when, direction, len(data), hexdump.hexdump(data, result='return'))
+
+    def dump(self, log, count=8):
+        """Log the last count frames, oldest first"""
+        frames = self.recent(count)
+        log("Last {:d} frames:".format(len(frames)))
+        for frame in frames:
+            print(self.format_frame(frame))
+
+    def start_printing(self):
+        """Print every frame from now on, formatted by a background thread"""
+        if self.printer is not None:
+            return
+        self.print_queue = queue.Queue()
+        self.printer = threading.Thread(target=self.print_frames, args=(self.print_queue,))
+        self.printer.daemon = True
+        self.printer.start()
+
+    def stop_printing(self):
+        if self.printer is None:
+            return
+        self.print_queue.put(None)
+        self.print_queue = None
+        self.printer = None
+
+    def print_frames(self, print_queue):
+        while True:
+            frame = print_queue.get()
+            if frame is None:
+                return
+            print(self.format_frame(frame))